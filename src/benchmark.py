@@ -0,0 +1,215 @@
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import simulation_framework
+from simulation_framework import *
+from sarsamouse import SarsaMouse, Q_TABLE_TYPES, BINARY_SAVE_EXTENSION
+from vec_game_manager import StackedSense
+
+# Measures how fast the simulation and the agent run, and writes the results
+# to a JSON file so they can be compared between commits:
+#   python benchmark.py [results.json]
+# Every game and table is made from fixed seeds, so runs on the same machine
+# do the same work.
+
+RESULTS_FNAME = "benchmark_results.json"
+SEED = 0
+
+# Each benchmark is timed this many times and the fastest run is kept.
+REPEATS = 3
+
+# (NUM_AGENTS, NUM_EVIL) of the scenarios in the README
+SCENARIOS = {
+    "scenario1": (1, 0),
+    "scenario2": (1, 1),
+    "scenario3": (5, 1),
+}
+
+TICKS_PER_RUN = 2000
+SENSE_COUNT = 500
+# Number of states in the Q-tables getAction and update are timed against
+Q_TABLE_SIZES = (1000, 10000, 100000)
+# Saved agent whose size the save and load benchmarks use
+SAVE_BENCHMARK_FNAME = path.join(ABS_PATH, "oldmouse.json")
+
+
+def timeCalls(function, calls, setup=None):
+    """ Fastest time of REPEATS runs of calls calls to function """
+    best = None
+    for repeat in range(REPEATS):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for i in range(calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return {"calls": calls, "seconds_per_call": best / calls, "calls_per_second": calls / best}
+
+
+class Scenario:
+    """ Sets the number of agents and evil agents while in a with block """
+    def __init__(self, name):
+        self.num_agents, self.num_evil = SCENARIOS[name]
+
+    def __enter__(self):
+        self.saved = simulation_framework.NUM_AGENTS, simulation_framework.NUM_EVIL
+        simulation_framework.NUM_AGENTS = self.num_agents
+        simulation_framework.NUM_EVIL = self.num_evil
+
+    def __exit__(self, *exc_info):
+        simulation_framework.NUM_AGENTS, simulation_framework.NUM_EVIL = self.saved
+
+
+def benchLogicTick(name):
+    with Scenario(name):
+        gm = GameManager(GAME_GRID_WIDTH, GAME_GRID_HEIGHT, 0, headless=True, seed=SEED)
+        moves = random.Random(SEED)
+        episode = [0]
+
+        def tick():
+            gm.logicTick(moves.randint(0, 8))
+            if not gm.main_agent.alive:
+                episode[0] += 1
+                gm.reset(episode[0], seed=SEED + episode[0])
+
+        return timeCalls(tick, TICKS_PER_RUN)
+
+
+def benchSenseUpdate():
+    with Scenario("scenario3"):
+        gm = GameManager(GAME_GRID_WIDTH, GAME_GRID_HEIGHT, 0, headless=True, seed=SEED)
+        agent = gm.main_agent
+        return timeCalls(lambda: agent.sense.update(agent.x, agent.y, gm.grid, gm.agent_store, gm.plant_store), TICKS_PER_RUN)
+
+
+def collectSenses(count):
+    """ Copies of the main agent's senses over count steps of seeded games """
+    with Scenario("scenario3"):
+        gm = GameManager(GAME_GRID_WIDTH, GAME_GRID_HEIGHT, 0, headless=True, seed=SEED)
+        moves = random.Random(SEED)
+        senses = []
+        for i in range(count):
+            gm.logicTick(moves.randint(0, 8))
+            # A stack of one copies the matrices. The copy has no stamp, so
+            # SarsaMouse encodes it every time instead of caching the state.
+            senses.append(StackedSense([gm.main_agent.sense])[0])
+            if not gm.main_agent.alive:
+                gm.reset(i, seed=SEED + i)
+    return senses
+
+
+def fillTable(mouse, numStates, stateWidth):
+    rng = np.random.RandomState(SEED)
+    states = rng.randint(0, 4 ** 8, size=(numStates, stateWidth))
+    values = rng.randn(numStates, mouse.actionCount)
+    for row, state in enumerate(map(tuple, states.tolist())):
+        for action in range(mouse.actionCount):
+            mouse.table.set(state, action, values[row, action], 0.0)
+
+
+def benchAgent(results, senses):
+    mouse = SarsaMouse(saveFname=None)
+    calls = len(senses)
+    index = [0]
+
+    def nextSense():
+        index[0] = (index[0] + 1) % calls
+        return senses[index[0]]
+
+    results["getStateFromSense"] = timeCalls(lambda: mouse.getStateFromSense(nextSense()), calls)
+
+    stateWidth = len(mouse.getStateFromSense(senses[0]))
+    states = [mouse.getStateFromSense(sense) for sense in senses]
+    actionRng = random.Random(SEED)
+    for qTableType in Q_TABLE_TYPES:
+        for numStates in Q_TABLE_SIZES:
+            mouse = SarsaMouse(qTableType, saveFname=None)
+            mouse.epsilon = 0.1
+            fillTable(mouse, numStates, stateWidth)
+            # Trained tables have the visited states in them too
+            for state in states:
+                for action in range(mouse.actionCount):
+                    mouse.table.set(state, action, 0.0, 0.0)
+
+            name = f"{qTableType}_{numStates}"
+            results[f"getAction_{name}"] = timeCalls(lambda: mouse.getAction(nextSense()), calls)
+
+            def update():
+                i = index[0] = (index[0] + 1) % calls
+                mouse.updateStates(states[i], actionRng.randint(0, 7), states[(i + 1) % calls],
+                                   actionRng.randint(0, 7), actionRng.random() - 0.5)
+            results[f"update_{name}"] = timeCalls(update, calls)
+
+
+def benchSaveLoad(results):
+    mouse = SarsaMouse(saveFname=SAVE_BENCHMARK_FNAME)
+    results["table_entries"] = len(mouse.table)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for kind, extension in (("json", ".json"), ("binary", BINARY_SAVE_EXTENSION)):
+            mouse.saveFname = path.join(tmpdir, "mouse" + extension)
+            results[f"save_{kind}"] = timeCalls(mouse.save, 5)
+            results[f"load_{kind}"] = timeCalls(lambda: SarsaMouse(saveFname=mouse.saveFname), 5)
+
+
+def benchReset(results):
+    with Scenario("scenario3"):
+        gm = GameManager(GAME_GRID_WIDTH, GAME_GRID_HEIGHT, 0, headless=True, seed=SEED)
+        episode = [0]
+
+        def reset(**kwargs):
+            episode[0] += 1
+            gm.reset(episode[0], seed=SEED + episode[0], **kwargs)
+
+        results["reset"] = timeCalls(reset, 200)
+        results["reset_keep_terrain"] = timeCalls(lambda: reset(keep_terrain=True), 200)
+        results["new_game_manager"] = timeCalls(
+            lambda: GameManager(GAME_GRID_WIDTH, GAME_GRID_HEIGHT, 0, headless=True, seed=SEED), 200)
+
+
+def getCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ABS_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmarks():
+    results = {}
+    for name in SCENARIOS:
+        results[f"logicTick_{name}"] = benchLogicTick(name)
+        print(f"logicTick {name}: {round(results[f'logicTick_{name}']['calls_per_second'])} steps/s")
+    results["senseUpdate"] = benchSenseUpdate()
+    print("sense update done")
+    benchAgent(results, collectSenses(SENSE_COUNT))
+    print("agent done")
+    results["saveLoad"] = {}
+    benchSaveLoad(results["saveLoad"])
+    print("save and load done")
+    benchReset(results)
+    print("reset done")
+    return {
+        "commit": getCommit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "seed": SEED,
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    fname = sys.argv[1] if len(sys.argv) > 1 else RESULTS_FNAME
+    report = runBenchmarks()
+    with open(fname, 'w') as results_file:
+        json.dump(report, results_file, indent=2)
+    print(f"Results written to {fname}")
@@ -0,0 +1,134 @@
+import numpy as np
+
+# Structure of arrays storage for game objects. Every field of the objects in
+# an EntityStore is kept in one numpy array with a slot per object, so work
+# that touches all of them, like growing every plant, is a few array
+# operations. The objects stay the way the rest of the game sees them: a
+# StoreField on their class reads and writes their slot of the array, and
+# objects that aren't in a store keep the value in their own __dict__.
+#
+#   class Plant(GameObject):
+#       energy = StoreField()
+#
+#   store = EntityStore((("energy", np.int64),))
+#   store.attach(plant)
+#   store.arrays["energy"][:len(store)] += 1
+
+# Starting number of slots. The arrays double in size when they run out.
+DEFAULT_CAPACITY = 64
+
+
+class StoreField:
+    """ An attribute kept in the store array of the same name while the
+    object is in a store, and in the object's __dict__ otherwise """
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        store = obj.store
+        if store is None:
+            try:
+                return obj.__dict__[self.name]
+            except KeyError:
+                raise AttributeError(self.name) from None
+        return store.arrays[self.name][obj.slot].item()
+
+    def __set__(self, obj, value):
+        store = obj.store
+        if store is None:
+            obj.__dict__[self.name] = value
+        else:
+            store.arrays[self.name][obj.slot] = value
+
+
+class EntityStore:
+    """ Objects and the arrays of their fields. Slots 0 to count-1 are in
+    use and objects[i] is the object in slot i. Removing an object moves
+    the last one into its slot, so the slots in use stay together. """
+    def __init__(self, fields, capacity=DEFAULT_CAPACITY):
+        # (name, dtype) of every field
+        self.fields = tuple(fields)
+        self.names = tuple(name for name, dtype in self.fields)
+        self.arrays = {name: np.zeros(max(capacity, 1), dtype=dtype) for name, dtype in self.fields}
+        self.objects = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def view(self, name):
+        """ The array of a field, cut down to the slots in use """
+        return self.arrays[name][:self.count]
+
+    def grow(self, capacity):
+        for name, array in self.arrays.items():
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            self.arrays[name] = grown
+
+    def attach(self, obj):
+        """ Put an object in the next slot, moving its field values from its
+        __dict__ into the arrays """
+        slot = self.count
+        if slot == len(self.arrays[self.names[0]]):
+            self.grow(2 * slot)
+        values = obj.__dict__
+        for name in self.names:
+            self.arrays[name][slot] = values.pop(name)
+        obj.store = self
+        obj.slot = slot
+        self.objects.append(obj)
+        self.count += 1
+
+    def detach(self, obj):
+        """ Take an object out of the store, giving it back its field values """
+        slot = obj.slot
+        self.release(obj)
+        self.count -= 1
+        last = self.objects.pop()
+        if last is not obj:
+            for array in self.arrays.values():
+                array[slot] = array[self.count]
+            self.objects[slot] = last
+            last.slot = slot
+
+    def clear(self):
+        """ Take every object out of the store """
+        values = [array[:self.count].tolist() for array in self.arrays.values()]
+        for obj, obj_values in zip(self.objects, zip(*values)):
+            obj.__dict__.update(zip(self.names, obj_values))
+            obj.store = None
+            obj.slot = None
+        self.objects.clear()
+        self.count = 0
+
+    def release(self, obj):
+        for name, array in self.arrays.items():
+            obj.__dict__[name] = array[obj.slot].item()
+        obj.store = None
+        obj.slot = None
+
+    def getState(self):
+        """ The objects in the store and copies of their arrays """
+        return list(self.objects), {name: array[:self.count].copy() for name, array in self.arrays.items()}
+
+    def setState(self, state):
+        """ Put the store back the way getState found it. Objects that are in
+        the store now but weren't then are taken out. """
+        objects, arrays = state
+        saved = set(map(id, objects))
+        for obj in self.objects:
+            if id(obj) not in saved:
+                self.release(obj)
+        count = len(objects)
+        if count > len(self.arrays[self.names[0]]):
+            self.grow(count)
+        for name, array in arrays.items():
+            self.arrays[name][:count] = array
+        self.objects[:] = objects
+        self.count = count
+        for slot, obj in enumerate(objects):
+            obj.store = self
+            obj.slot = slot
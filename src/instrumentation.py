@@ -0,0 +1,121 @@
+from functools import wraps
+from time import perf_counter
+
+# Opt-in timing of the simulation's hot paths. Functions wrapped with
+# timed() record how long every call takes, and count() keeps counters of
+# events, but only while PROFILER is enabled. When it's off a wrapped call
+# only checks one flag.
+#
+#   PROFILER.enable()
+#   ... run some episodes ...
+#   print(PROFILER.summary())
+
+# Call times are kept in buckets that double in width, starting below 1us.
+# The last bucket holds everything from about 1 second up.
+HISTOGRAM_BUCKETS = 21
+
+
+class Histogram:
+    """ Call count, total, largest and bucketed wall times of one phase """
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        # Bucket i holds times under 2**i microseconds
+        bucket = min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """ Upper bound of the bucket the given fraction of calls falls in,
+        in seconds """
+        if self.count == 0:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return min(2 ** bucket / 1e6, self.max)
+        return self.max
+
+    def getStats(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "buckets": list(self.buckets),
+        }
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {}
+        self.counters = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def record(self, phase, seconds):
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = Histogram()
+        histogram.add(seconds)
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def getStats(self):
+        return {
+            "phases": {phase: histogram.getStats() for phase, histogram in self.histograms.items()},
+            "counters": dict(self.counters),
+        }
+
+    def summary(self):
+        """ One line with the mean and p99 time of every phase, and the
+        counters """
+        parts = []
+        for phase, histogram in self.histograms.items():
+            stats = histogram.getStats()
+            parts.append(f"{phase} {stats['count']}x {stats['mean'] * 1e6:.1f}us p99<{stats['p99'] * 1e6:.0f}us")
+        for name, value in self.counters.items():
+            parts.append(f"{name} {value}")
+        return " | ".join(parts)
+
+
+PROFILER = Profiler()
+
+
+def timed(phase):
+    """ Records the wall time of every call to the wrapped function under
+    phase while PROFILER is enabled """
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                PROFILER.record(phase, perf_counter() - start)
+        return wrapper
+    return decorate
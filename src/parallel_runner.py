@@ -0,0 +1,155 @@
+from multiprocessing import Pipe, Process
+import random
+from simulation_framework import *
+from sarsamouse import SarsaMouse, AsyncCheckpointer
+from vec_game_manager import MAX_EPISODE_SCORE
+
+# Trains the agent by running episodes in several worker processes at once.
+# Every worker loads its own copy of the agent from the same save as the main
+# agent, once. After each worker has run MERGE_INTERVAL episodes, it sends
+# back the changes it made to the Q-values of the pairs it updated, and puts
+# its copy back the way it was. The changes are added to the main agent and
+# sent to every worker with its next block, so all copies stay the same as the
+# main agent without the table ever being sent. Only Q-values are merged, so
+# the main agent keeps no eligibility traces and every copy starts its block
+# without any.
+
+# Number of worker processes to run episodes in.
+NUM_WORKERS = 4
+
+# How many episodes each worker runs between merges.
+MERGE_INTERVAL = 10
+
+# Each game is seeded with BASE_SEED plus its episode number, so an episode
+# plays out the same no matter which worker runs it. The agent's own random
+# choices in a block are seeded with BASE_SEED plus the block's first episode.
+BASE_SEED = 0
+
+number_of_episodes = 20000
+autosave_interval = 100  # Saves agent after this many episodes
+
+
+def runEpisode(game_manager, mouse):
+    state1 = game_manager.main_agent.sense
+    action1 = mouse.getAction(state1)
+    main_agent = game_manager.main_agent
+
+    while True:
+        game_manager.logicTick(action1)
+        state2 = main_agent.sense
+        action2 = mouse.getAction(state2)
+        reward = main_agent.deltaEnergy + main_agent.deltaDamage - 1
+        mouse.update(state1, action1, state2, action2, reward)
+        state1 = state2
+        action1 = action2
+        main_agent.deltaDamage = main_agent.deltaEnergy = 0.
+        if not main_agent.alive or main_agent.score > MAX_EPISODE_SCORE:
+            return
+
+
+def runEpisodes(mouse, job):
+    """ Runs a block of episodes on a worker's copy of the agent. Episodes are
+    numbered the same as they would be in a single process, so epsilon and
+    alpha decay the same way. Returns the changes made to the Q-values, the
+    number of updates done and the score of each episode. The copy's
+    Q-values are left as they were. """
+    baseK, firstEpisode, numEpisodes, seed = job
+    random.seed(seed)
+
+    # The saved k also counts the episodes already run by this training run.
+    mouse.k = baseK
+    if baseK + firstEpisode > 0:
+        mouse.decayEpsilon(firstEpisode)
+    startUpdateCount = mouse.updateCount
+    mouse.trackChanges()
+
+    scores = []
+    gm = None
+    for episode in range(firstEpisode, firstEpisode + numEpisodes):
+        if gm is None:
+            gm = GameManager(GAME_GRID_WIDTH, GAME_GRID_HEIGHT, episode, headless=True, seed=BASE_SEED + episode)
+        else:
+            gm.reset(episode, seed=BASE_SEED + episode)
+        runEpisode(gm, mouse)
+        scores.append(gm.main_agent.score)
+        mouse.decayEpsilon(episode + 1)
+
+    return mouse.takeChanges(), mouse.updateCount - startUpdateCount, scores
+
+
+def applyDeltas(mouse, deltas):
+    for state, action, delta in deltas:
+        mouse.table.addToQ(state, action, delta)
+
+
+def mergeDeltas(mouse, results):
+    """ Adds the changes from every block to the agent, in block order.
+    Returns all of the changes in the order they were added. """
+    merged = []
+    for deltas, updateCount, scores in results:
+        merged.extend(deltas)
+        mouse.updateCount += updateCount
+    applyDeltas(mouse, merged)
+    mouse.clearTraces()
+    return merged
+
+
+def runWorker(connection):
+    """ Worker process. Gets (changes, job) pairs until it gets None. The
+    changes merged into the main agent are added to this worker's copy, then
+    the job's block is run on it and its results sent back. A job of None
+    only brings the copy up to date. """
+    mouse = SarsaMouse()
+    mouse.saveFname = None
+    mouse.clearTraces()
+    for merged, job in iter(connection.recv, None):
+        applyDeltas(mouse, merged)
+        if job is not None:
+            connection.send(runEpisodes(mouse, job))
+
+
+if __name__ == "__main__":
+    agent = SarsaMouse()
+    # Traces in a saved agent would be in every worker's copy
+    agent.clearTraces()
+    checkpointer = AsyncCheckpointer(agent)
+    baseK = agent.k
+    highScore = 0
+    lastSave = 0
+    episode = 0
+
+    # The workers load their copies from the save before the first block
+    # finishes, so before anything is saved over it.
+    connections = []
+    for i in range(NUM_WORKERS):
+        connection, workerConnection = Pipe()
+        Process(target=runWorker, args=(workerConnection,), daemon=True).start()
+        connections.append(connection)
+
+    merged = []
+    while episode < number_of_episodes:
+        jobs = []
+        for first in range(episode, min(episode + NUM_WORKERS * MERGE_INTERVAL, number_of_episodes), MERGE_INTERVAL):
+            count = min(MERGE_INTERVAL, number_of_episodes - first)
+            jobs.append((baseK, first, count, BASE_SEED + first))
+        jobs += [None] * (NUM_WORKERS - len(jobs))
+
+        for connection, job in zip(connections, jobs):
+            connection.send((merged, job))
+        results = [connection.recv() for connection, job in zip(connections, jobs) if job is not None]
+        merged = mergeDeltas(agent, results)
+        episode += sum(job[2] for job in jobs if job is not None)
+        agent.decayEpsilon(episode)
+
+        for deltas, updateCount, scores in results:
+            highScore = max([highScore] + scores)
+        print(f"episodes: {episode}  updates: {agent.updateCount}  epsilon: {round(agent.epsilon, 4)}  high score: {round(highScore, 2)}")
+
+        if episode - lastSave >= autosave_interval:
+            checkpointer.save()
+            lastSave = episode
+
+    for connection in connections:
+        connection.send(None)
+    checkpointer.wait()
+    agent.save()
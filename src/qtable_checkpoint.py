@@ -0,0 +1,138 @@
+import numpy as np
+import json
+import os
+import sys
+
+# Binary Q-table checkpoints.
+#
+# A checkpoint starts with CHECKPOINT_MAGIC, then the length of a JSON header
+# as a little endian uint64, then the header itself. The header holds the
+# agent's settings (everything SarsaMouse saves apart from the table) and the
+# shape of every array. The arrays follow, one row per state, each starting
+# on an ARRAY_ALIGNMENT byte boundary so they can be memory-mapped as is:
+#   states   int64    (n_states, state_width)   state tuple of each row
+#   visited  uint8    (n_states, action_count)  1 for pairs in the table
+#   Q        float64  (n_states, action_count)
+#   E        float64  (n_states, action_count)
+# The header also holds the table's counters, so loading doesn't have to
+# scan the arrays for them.
+
+BINARY_SAVE_EXTENSION = ".qtable"
+CHECKPOINT_MAGIC = b"SARSAQT1"
+ARRAY_ALIGNMENT = 64
+ARRAY_DTYPES = (("states", "<i8"), ("visited", "u1"), ("Q", "<f8"), ("E", "<f8"))
+
+# Keys of the saved JSON data that hold the table itself
+JSON_TABLE_KEYS = ("dataKeysState", "dataKeysAction", "dataValues")
+
+
+def align(offset):
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+
+def entriesToArrays(states, actions, values, actionCount):
+    """ Turns parallel lists of state tuples, actions and (Q, e) pairs into
+    the checkpoint arrays """
+    if len(states) == 0:
+        return {
+            "states": np.zeros((0, 0), dtype=np.int64),
+            "visited": np.zeros((0, actionCount), dtype=np.uint8),
+            "Q": np.zeros((0, actionCount)),
+            "E": np.zeros((0, actionCount)),
+        }
+    states = np.asarray(states, dtype=np.int64)
+    actions = np.asarray(actions, dtype=np.intp)
+    values = np.asarray(values, dtype=np.float64)
+    uniqueStates, rows = np.unique(states, axis=0, return_inverse=True)
+    rows = rows.reshape(-1)
+    arrays = {
+        "states": uniqueStates,
+        "visited": np.zeros((len(uniqueStates), actionCount), dtype=np.uint8),
+        "Q": np.zeros((len(uniqueStates), actionCount)),
+        "E": np.zeros((len(uniqueStates), actionCount)),
+    }
+    arrays["visited"][rows, actions] = 1
+    arrays["Q"][rows, actions] = values[:, 0]
+    arrays["E"][rows, actions] = values[:, 1]
+    return arrays
+
+
+def countArrays(arrays):
+    """ Counters of the table in checkpoint arrays: visited pairs, nonzero
+    Q-values, nonzero traces, and the rows that have any traces """
+    return {
+        "visited": int(np.count_nonzero(arrays["visited"])),
+        "nonzero": int(np.count_nonzero(arrays["Q"])),
+        "liveTraces": int(np.count_nonzero(arrays["E"])),
+        "liveRows": np.flatnonzero(np.asarray(arrays["E"]).any(axis=1)).tolist(),
+    }
+
+
+def writeCheckpoint(fname, settings, arrays):
+    """ Writes a checkpoint to a temporary file and then moves it over fname.
+    A table memory-mapped from the old file keeps reading the old data, and
+    a crash while writing never leaves a half written checkpoint. """
+    header = dict(settings)
+    header["counts"] = countArrays(arrays)
+    header["arrays"] = {}
+    arrays = {name: np.ascontiguousarray(arrays[name], dtype=dtype) for name, dtype in ARRAY_DTYPES}
+    offset = 0
+    for name, dtype in ARRAY_DTYPES:
+        array = arrays[name]
+        header["arrays"][name] = {"offset": offset, "shape": list(array.shape)}
+        offset = align(offset + array.nbytes)
+    headerBytes = json.dumps(header).encode()
+
+    dataStart = align(len(CHECKPOINT_MAGIC) + 8 + len(headerBytes))
+    tmpFname = fname + ".tmp"
+    with open(tmpFname, 'wb') as checkpoint_file:
+        checkpoint_file.write(CHECKPOINT_MAGIC)
+        checkpoint_file.write(np.uint64(len(headerBytes)).astype("<u8").tobytes())
+        checkpoint_file.write(headerBytes)
+        for name, dtype in ARRAY_DTYPES:
+            checkpoint_file.seek(dataStart + header["arrays"][name]["offset"])
+            checkpoint_file.write(arrays[name].tobytes())
+        checkpoint_file.truncate(dataStart + offset)
+    os.replace(tmpFname, fname)
+
+
+def readCheckpoint(fname, mmap=True):
+    """ Returns the settings and arrays of a checkpoint. With mmap the arrays
+    are copy-on-write maps of the file, so nothing is read until it's used
+    and changes never reach the file. """
+    with open(fname, 'rb') as checkpoint_file:
+        if checkpoint_file.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+            raise ValueError(f"{fname} is not a Q-table checkpoint")
+        headerLength = int(np.frombuffer(checkpoint_file.read(8), dtype="<u8")[0])
+        header = json.loads(checkpoint_file.read(headerLength))
+        dataStart = align(len(CHECKPOINT_MAGIC) + 8 + headerLength)
+
+        arrays = {}
+        for name, dtype in ARRAY_DTYPES:
+            info = header["arrays"].pop(name)
+            shape = tuple(info["shape"])
+            if mmap and np.prod(shape) > 0:
+                arrays[name] = np.memmap(fname, dtype=dtype, mode='c', offset=dataStart + info["offset"], shape=shape)
+            else:
+                checkpoint_file.seek(dataStart + info["offset"])
+                count = int(np.prod(shape))
+                arrays[name] = np.fromfile(checkpoint_file, dtype=dtype, count=count).reshape(shape)
+    del header["arrays"]
+    return header, arrays
+
+
+def convertJsonCheckpoint(jsonFname, binaryFname):
+    """ Converts a mouse saved as JSON into a binary checkpoint """
+    with open(jsonFname) as json_file:
+        data = json.load(json_file)
+    settings = {key: value for key, value in data.items() if key not in JSON_TABLE_KEYS}
+    arrays = entriesToArrays(data["dataKeysState"], data["dataKeysAction"], data["dataValues"],
+                             data["possibleActions"])
+    writeCheckpoint(binaryFname, settings, arrays)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python qtable_checkpoint.py <mouse.json> <mouse" + BINARY_SAVE_EXTENSION + ">")
+        exit(1)
+    convertJsonCheckpoint(sys.argv[1], sys.argv[2])
@@ -1,14 +1,470 @@
 import numpy as np
 import random
 import json
+import os
+import threading
+import time
+import weakref
+from qtable_checkpoint import BINARY_SAVE_EXTENSION, entriesToArrays, countArrays, writeCheckpoint, readCheckpoint
+from instrumentation import timed
 
 MOUSE_SAVE_FNAME = "mouse.json"
+# Saving to a file with this name uses the binary checkpoint format instead
+MOUSE_BINARY_SAVE_FNAME = "mouse" + BINARY_SAVE_EXTENSION
+
+# Makes the runners save the agent as a binary checkpoint instead of JSON.
+# Binary checkpoints are much faster to write and load for large Q-tables,
+# and an "array" table uses the loaded arrays as they are, so it's the
+# default table with binary saves.
+BINARY_SAVE = False
+SAVE_FNAME = MOUSE_BINARY_SAVE_FNAME if BINARY_SAVE else MOUSE_SAVE_FNAME
+# Q-table backend used by default, see Q_TABLE_TYPES
+Q_TABLE_TYPE = "array" if BINARY_SAVE else "dict"
+
+def getSaveData(settings, table):
+    # The saved settings plus the table, in the format SarsaMouse.load takes
+    data = dict(settings)
+    data["dataKeysState"] = []
+    data["dataKeysAction"] = []
+    data["dataValues"] = []
+    for state, action, q, e in table.items():
+        data["dataKeysState"].append(state)
+        data["dataKeysAction"].append(action)
+        data["dataValues"].append((q, e))
+    return data
+
+def writeSave(fname, settings, table):
+    # Writes a json file, or a binary checkpoint if the file name ends with
+    # BINARY_SAVE_EXTENSION. Either way the file is written under a temporary
+    # name first and then moved over the old one, so a crash while saving
+    # never leaves a broken save behind.
+    if fname.endswith(BINARY_SAVE_EXTENSION):
+        writeCheckpoint(fname, settings, table.toArrays())
+        return
+    tmpFname = fname + ".tmp"
+    with open(tmpFname, 'w') as json_file:
+        json.dump(getSaveData(settings, table), json_file)
+    os.replace(tmpFname, fname)
+
+class DictQTable:
+    """ Q-values and eligibility traces kept in dicts keyed by (stateTuple, action) """
+    def __init__(self, actionCount):
+        self.actionCount = actionCount
+        # Q-values, keyed by (stateTuple, action)
+        self.Q = {}
+        # Eligibility traces. Only holds the (stateTuple, action) pairs with a
+        # nonzero trace; entries are dropped once they fall below the cutoff.
+        self.E = {}
+        # Number of nonzero Q-values, kept up to date as they change
+        self.nonzero = 0
+
+    def __len__(self):
+        return len(self.Q)
+
+    def getQ(self, state, action):
+        return self.Q.get((state, action), 0.0)
+
+    def getActionValues(self, state):
+        return [self.Q.get((state, action), 0.0) for action in range(self.actionCount)]
+
+    def getBestActions(self, state):
+        actions = self.getActionValues(state)
+        best = max(actions)
+        return [i for i, x in enumerate(actions) if x == best]
+
+    def visit(self, state, action):
+        """ Bumps the trace of (state, action) and returns its Q-value """
+        key = (state, action)
+        Q = self.Q.get(key, 0.0)
+        self.Q[key] = Q
+        self.E[key] = self.E.get(key, 0.0) + 1.0
+        return Q
+
+    def applyError(self, step, decay, cutoff):
+        # Only the (state, action) pairs with a live eligibility trace are
+        # visited, so the cost of an update doesn't grow with the Q-table.
+        liveTraces = {}
+        Q = self.Q
+        for key, eligibilityTrace in self.E.items():
+            oldQ = Q[key]
+            newQ = Q[key] = oldQ + step * eligibilityTrace
+            if (oldQ == 0.0) != (newQ == 0.0):
+                self.nonzero += 1 if oldQ == 0.0 else -1
+            newE = decay * eligibilityTrace
+            if newE > cutoff:
+                liveTraces[key] = newE
+        self.E = liveTraces
+
+    def liveTraceCount(self):
+        return len(self.E)
+
+    def takeTraces(self):
+        """ Removes the eligibility traces from the table and returns them """
+        traces, self.E = self.E, {}
+        return traces
+
+    def putTraces(self, traces):
+        """ Gives a table with no traces the ones takeTraces returned. None
+        puts in no traces. """
+        if traces is not None:
+            self.E = traces
+
+    def nonzeroCount(self):
+        return self.nonzero
+
+    def changeQ(self, key, q):
+        if (self.Q.get(key, 0.0) == 0.0) != (q == 0.0):
+            self.nonzero += 1 if q != 0.0 else -1
+        self.Q[key] = q
+
+    def items(self):
+        for key, q in self.Q.items():
+            yield key[0], key[1], q, self.E.get(key, 0.0)
+
+    def set(self, state, action, q, e):
+        self.changeQ((state, action), q)
+        if e > 0.0:
+            self.E[state, action] = e
+
+    def addToQ(self, state, action, amount):
+        self.changeQ((state, action), self.Q.get((state, action), 0.0) + amount)
+
+    def copy(self):
+        table = DictQTable(self.actionCount)
+        table.Q = dict(self.Q)
+        table.E = dict(self.E)
+        table.nonzero = self.nonzero
+        return table
+
+    def toArrays(self):
+        states, actions, values = [], [], []
+        for state, action, q, e in self.items():
+            states.append(state)
+            actions.append(action)
+            values.append((q, e))
+        return entriesToArrays(states, actions, values, self.actionCount)
+
+    def loadArrays(self, arrays, counts=None):
+        """ Replaces the table with the one in checkpoint arrays. counts are
+        the checkpoint's counters, worked out from the arrays if not given. """
+        if counts is None:
+            counts = countArrays(arrays)
+        states = [tuple(state) for state in np.asarray(arrays["states"]).tolist()]
+        rows, actions = np.nonzero(arrays["visited"])
+        keys = list(zip([states[row] for row in rows.tolist()], actions.tolist()))
+        self.Q = dict(zip(keys, arrays["Q"][rows, actions].tolist()))
+        E = arrays["E"][rows, actions]
+        live = np.flatnonzero(E > 0.0)
+        self.E = dict(zip([keys[i] for i in live.tolist()], E[live].tolist()))
+        self.nonzero = counts["nonzero"]
+
+
+class ArrayQTable:
+    """ Q-values and eligibility traces kept in (n_states, actionCount) float64
+    arrays. Each state tuple is given a dense row index the first time it's
+    visited. """
+    def __init__(self, actionCount, capacity=1024):
+        self.actionCount = actionCount
+        self.stateIndex = {}
+        self.states = []
+        self.Q = np.zeros((capacity, actionCount))
+        self.E = np.zeros((capacity, actionCount))
+        # Marks the (state, action) pairs that have been visited, so only
+        # those are written out when saving.
+        self.visited = np.zeros((capacity, actionCount), dtype=bool)
+        # Rows with at least one nonzero eligibility trace
+        self.liveRows = set()
+        # Numbers of visited pairs, nonzero Q-values and nonzero traces, kept
+        # up to date as they change
+        self.visitedCount = 0
+        self.nonzero = 0
+        self.liveTraces = 0
+
+    def __len__(self):
+        return self.visitedCount
+
+    def getRow(self, state):
+        row = self.stateIndex.get(state)
+        if row is None:
+            row = len(self.states)
+            if row == self.Q.shape[0]:
+                self.grow()
+            self.stateIndex[state] = row
+            self.states.append(state)
+        return row
+
+    def grow(self):
+        capacity = max(self.Q.shape[0] * 2, 1)
+        for name in ("Q", "E", "visited"):
+            old = getattr(self, name)
+            new = np.zeros((capacity, self.actionCount), dtype=old.dtype)
+            new[:old.shape[0]] = old
+            setattr(self, name, new)
+
+    def getQ(self, state, action):
+        row = self.stateIndex.get(state)
+        if row is None:
+            return 0.0
+        return float(self.Q[row, action])
+
+    def getActionValues(self, state):
+        row = self.stateIndex.get(state)
+        if row is None:
+            return np.zeros(self.actionCount)
+        return self.Q[row]
+
+    def getBestActions(self, state):
+        row = self.stateIndex.get(state)
+        if row is None:
+            return list(range(self.actionCount))
+        values = self.Q[row]
+        return np.flatnonzero(values == values.max()).tolist()
+
+    def visit(self, state, action):
+        """ Bumps the trace of (state, action) and returns its Q-value """
+        row = self.getRow(state)
+        self.markVisited(row, action)
+        if self.E[row, action] == 0.0:
+            self.liveTraces += 1
+        self.E[row, action] += 1.0
+        self.liveRows.add(row)
+        return float(self.Q[row, action])
+
+    def markVisited(self, row, action):
+        if not self.visited[row, action]:
+            self.visited[row, action] = True
+            self.visitedCount += 1
+
+    def applyError(self, step, decay, cutoff):
+        if not self.liveRows:
+            return
+        rows = np.fromiter(self.liveRows, dtype=np.intp, count=len(self.liveRows))
+        traces = self.E[rows]
+        Q = self.Q[rows]
+        self.nonzero -= np.count_nonzero(Q)
+        Q += step * traces
+        self.nonzero += np.count_nonzero(Q)
+        self.Q[rows] = Q
+        traces *= decay
+        traces[~(traces > cutoff)] = 0.0
+        self.E[rows] = traces
+        self.liveTraces = int(np.count_nonzero(traces))
+        self.liveRows = set(rows[traces.any(axis=1)].tolist())
+
+    def liveTraceCount(self):
+        return self.liveTraces
+
+    def takeTraces(self):
+        """ Removes the eligibility traces from the table and returns them,
+        as the rows that have any and the traces of those rows """
+        rows = np.fromiter(self.liveRows, dtype=np.intp, count=len(self.liveRows))
+        traces = self.E[rows]
+        self.E[rows] = 0.0
+        self.liveRows = set()
+        self.liveTraces = 0
+        return rows, traces
+
+    def putTraces(self, traces):
+        """ Gives a table with no traces the ones takeTraces returned. None
+        puts in no traces. """
+        if traces is None:
+            return
+        rows, traces = traces
+        self.E[rows] = traces
+        self.liveRows = set(rows.tolist())
+        self.liveTraces = int(np.count_nonzero(traces))
+
+    def nonzeroCount(self):
+        return int(self.nonzero)
+
+    def items(self):
+        rows, actions = np.nonzero(self.visited[:len(self.states)])
+        for row, action in zip(rows.tolist(), actions.tolist()):
+            yield self.states[row], action, float(self.Q[row, action]), float(self.E[row, action])
+
+    def set(self, state, action, q, e):
+        row = self.getRow(state)
+        self.markVisited(row, action)
+        self.changeQ(row, action, q)
+        self.liveTraces += int(e != 0.0) - int(self.E[row, action] != 0.0)
+        self.E[row, action] = e
+        if e > 0.0:
+            self.liveRows.add(row)
+
+    def addToQ(self, state, action, amount):
+        row = self.getRow(state)
+        self.markVisited(row, action)
+        self.changeQ(row, action, self.Q[row, action] + amount)
+
+    def changeQ(self, row, action, q):
+        self.nonzero += int(q != 0.0) - int(self.Q[row, action] != 0.0)
+        self.Q[row, action] = q
+
+    def copy(self):
+        count = len(self.states)
+        table = ArrayQTable(self.actionCount, capacity=0)
+        table.states = list(self.states)
+        table.stateIndex = dict(self.stateIndex)
+        table.Q = self.Q[:count].copy()
+        table.E = self.E[:count].copy()
+        table.visited = self.visited[:count].copy()
+        table.liveRows = set(self.liveRows)
+        table.visitedCount = self.visitedCount
+        table.nonzero = self.nonzero
+        table.liveTraces = self.liveTraces
+        return table
+
+    def toArrays(self):
+        count = len(self.states)
+        # An empty table has no states to take the state width from
+        states = np.array(self.states, dtype=np.int64).reshape(count, -1) if count else np.zeros((0, 0), dtype=np.int64)
+        return {
+            "states": states,
+            "visited": self.visited[:count],
+            "Q": self.Q[:count],
+            "E": self.E[:count],
+        }
+
+    def loadArrays(self, arrays, counts=None):
+        """ Replaces the table with the one in checkpoint arrays. counts are
+        the checkpoint's counters, worked out from the arrays if not given.
+
+        The Q, E and visited arrays are used as they are, so their values in
+        a memory-mapped checkpoint are only read from disk as rows get used.
+        The states are read straight away to index them, and with counts
+        nothing else is. """
+        if counts is None:
+            counts = countArrays(arrays)
+        self.states = [tuple(state) for state in np.asarray(arrays["states"]).tolist()]
+        self.stateIndex = {state: row for row, state in enumerate(self.states)}
+        self.Q = arrays["Q"]
+        self.E = arrays["E"]
+        self.visited = arrays["visited"].view(bool)
+        self.liveRows = set(counts["liveRows"])
+        self.visitedCount = counts["visited"]
+        self.nonzero = counts["nonzero"]
+        self.liveTraces = counts["liveTraces"]
+
+
+# Q-table backends that can be picked when creating a SarsaMouse
+Q_TABLE_TYPES = {
+    "dict": DictQTable,
+    "array": ArrayQTable,
+}
+
+def flattenWithZero(matrices, size):
+    # Flattens a matrix, or a stack of them, into rows of size values followed
+    # by a zero that region indices can point at.
+    flat = np.asarray(matrices, dtype=float).reshape(-1, size)
+    return np.concatenate((flat, np.zeros((len(flat), 1))), axis=1)
+
+
+def getRadixPowers(base, rows, cols, skipMiddle):
+    # Place value of each element of a rows x cols matrix when its digits are
+    # read as one number, most significant first. A skipped middle element
+    # is worth nothing.
+    count = rows * cols - (1 if skipMiddle else 0)
+    powers = base ** np.arange(count - 1, -1, -1, dtype=np.int64)
+    if skipMiddle:
+        powers = np.insert(powers, (rows // 2) * cols + cols // 2, 0)
+    return powers
+
+
+def getRegionIndices(width, regions):
+    """ Flat indices of each region of a width x width matrix, where a region
+    is a pair of row and column lists like the ones given to np.ix_. Every
+    region is padded to the same length with width * width, which is the
+    index of a zero appended to the flattened matrix. """
+    indices = [[row * width + col for row in rows for col in cols] for rows, cols in regions]
+    length = max(len(region) for region in indices)
+    counts = np.array([len(region) for region in indices], dtype=float)
+    padded = np.array([region + [width * width] * (length - len(region)) for region in indices])
+    return padded, counts
+
+
+class StateEncoder:
+    """ Turns an AgentSense into the state tuple used to look up Q-values.
+
+    All of the regions that get averaged or searched for 255 are gathered
+    with flat indices worked out once, instead of slicing the matrices with
+    np.ix_ every time. The sums are done in the same order as np.average, so
+    states are exactly the same as before.
+
+    The state of an AgentSense is remembered until the sense is updated
+    again, so the same sense is never encoded twice. """
+    def __init__(self, scentSpace, terrainSpace, stateFromMatrix):
+        self.scentSpace = scentSpace
+        self.terrainSpace = terrainSpace
+        self.stateFromMatrix = stateFromMatrix
+
+        # The 5x5 terrain sight is split into the 8 regions around the agent
+        # (the middle row and column are their own regions).
+        bands = [[0, 1], [2], [3, 4]]
+        terrainRegions = [(rows, cols) for rows in bands for cols in bands if not (rows == [2] and cols == [2])]
+        self.terrainIndices, self.terrainCounts = getRegionIndices(5, terrainRegions)
+
+        # Danger and food sight only look at the corners of each quadrant
+        quadrantCorners = [([0, 2], [0, 2]), ([0, 2], [2, 4]), ([2, 4], [0, 2]), ([2, 4], [2, 4])]
+        self.sightIndices, _ = getRegionIndices(5, quadrantCorners)
+
+        # Food smell is averaged over the four overlapping 2x2 quadrants
+        smellQuadrants = [([0, 1], [0, 1]), ([0, 1], [1, 2]), ([1, 2], [0, 1]), ([1, 2], [1, 2])]
+        self.smellIndices, self.smellCounts = getRegionIndices(3, smellQuadrants)
+
+        self.cache = weakref.WeakKeyDictionary()
+
+    def encode(self, sense):
+        stamp = getattr(sense, "stamp", None)
+        if stamp is not None:
+            try:
+                cached = self.cache.get(sense)
+            except TypeError:
+                cached = None
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+
+        state = self.calcState(sense)
+        if stamp is not None:
+            try:
+                self.cache[sense] = (stamp, state)
+            except TypeError:
+                # Objects that can't be weakly referenced aren't cached
+                pass
+        return state
+
+    def calcState(self, sense):
+        return tuple(int(codes[0]) for codes in self.calcStates(sense))
+
+    def encodeBatch(self, senses):
+        """ States of a batch of senses whose matrices are stacked along a
+        first axis, such as a StackedSense. Nothing is cached. """
+        return list(zip(*[codes.tolist() for codes in self.calcStates(senses)]))
+
+    def calcStates(self, sense):
+        # Works on a single sense or on a stack of them. Returns an array of
+        # codes for each part of the state.
+        terrainSight = flattenWithZero(sense.elevation_sight, 25)
+        terrainAverages = terrainSight[:, self.terrainIndices].sum(axis=2) / self.terrainCounts
+        simplifiedTerrainSight = np.insert(terrainSight[:, 12:13] - terrainAverages, 4, 0., axis=1).reshape(-1, 3, 3)
+        terrainState = self.stateFromMatrix(simplifiedTerrainSight, self.terrainSpace)
+
+        dangerSight = flattenWithZero(sense.danger_sight, 25)
+        simplifiedDangerSight = (dangerSight[:, self.sightIndices] == 255.).any(axis=2).astype(float).reshape(-1, 2, 2)
+        dangerState = self.stateFromMatrix(simplifiedDangerSight, [0., 1.], False)
+
+        foodSight = flattenWithZero(sense.food_sight, 25)
+        simplifiedFoodSight = (foodSight[:, self.sightIndices] == 255.).any(axis=2).astype(float).reshape(-1, 2, 2)
+        foodSightState = self.stateFromMatrix(simplifiedFoodSight, [0., 1.], False)
+
+        foodSmell = flattenWithZero(sense.food_smell, 9)
+        simplifiedFoodSmell = (foodSmell[:, self.smellIndices].sum(axis=2) / self.smellCounts).reshape(-1, 2, 2)
+        foodSmellState = self.stateFromMatrix(simplifiedFoodSmell, self.scentSpace, False)
+
+        return foodSightState, foodSmellState, dangerState, terrainState
 
-def getAvgOfSubMatrix(matrix, axis0, axis1):
-    return np.average(matrix[np.ix_(axis0, axis1)])
 
 class SarsaMouse:
-    def __init__(self):
+    def __init__(self, qTableType=Q_TABLE_TYPE, saveFname=SAVE_FNAME):
         self.alpha = 1
         self.gamma = 0.9
         self.epsilon = 1
@@ -24,12 +480,31 @@ class SarsaMouse:
         self.scentSpace = np.linspace(0.0, 100.0, 4).tolist()
         self.terrainSpace = np.linspace(-125.0, 125.0, 4).tolist()
 
-        self.QE = {}
+        # Place values used by getStateFromMatrix, by matrix shape and space size
+        self.radixPowers = {}
+        self.encoder = StateEncoder(self.scentSpace, self.terrainSpace, self.getStateFromMatrix)
+
+        self.qTableClass = Q_TABLE_TYPES[qTableType]
+        self.table = self.qTableClass(self.actionCount)
+        # Eligibility traces of each world updateBatch is given, kept out of
+        # the table between batches
+        self.worldTraces = []
+        # While changes are tracked, the Q-value each updated pair had when
+        # tracking started, keyed by (stateTuple, action)
+        self.touched = None
+
+        # A mouse without a save file starts from scratch and is never saved.
+        self.saveFname = saveFname
+        if saveFname is None:
+            return
 
         try:
-            with open(MOUSE_SAVE_FNAME) as json_file:
-                data = json.load(json_file)
-                self.load(data)
+            if saveFname.endswith(BINARY_SAVE_EXTENSION):
+                self.loadBinary(saveFname)
+            else:
+                with open(saveFname) as json_file:
+                    data = json.load(json_file)
+                    self.load(data)
         except Exception as e:
             print(e)
 
@@ -45,57 +520,40 @@ class SarsaMouse:
             exit(0)
         self.epsilon = self.alpha = newValue
 
+    @timed("SarsaMouse.update")
     def update(self, state, action, statePrime, actionPrime, reward):
-        e = 1
-        Q = 0
-        QPrime = 0
-
         state = self.getStateFromSense(state)
         statePrime = self.getStateFromSense(statePrime)
+        self.updateStates(state, action, statePrime, actionPrime, reward)
 
-        try:
-            Q, e = self.QE[state, action]
-            self.QE[state, action] = (Q, e + 1.0)
-        except KeyError:
-            Q, e = self.QE[state, action] = (0.0, 1.0)
-
-        try:
-            QPrime, ePrime = self.QE[statePrime, actionPrime]
-        except KeyError:
-            QPrime = 0
+    def updateStates(self, state, action, statePrime, actionPrime, reward, done=False):
+        # Same as update, with senses that are already encoded. A transition
+        # that ended the episode has nothing after it to bootstrap on.
+        touched = self.touched
+        if touched is not None and (state, action) not in touched:
+            touched[state, action] = self.table.getQ(state, action)
+        Q = self.table.visit(state, action)
+        QPrime = 0.0 if done else self.table.getQ(statePrime, actionPrime)
 
         err = reward + self.gamma * QPrime - Q
 
-        for key in self.QE.keys():
-            qValue, eligibilityTrace = self.QE[key]
-            if eligibilityTrace == 0.0:
-                continue
-            newQ = qValue + self.alpha * err * eligibilityTrace
-            newE = self.gamma * self.lam * eligibilityTrace
-            self.QE[key] = (newQ, newE if newE > self.eligibilityCutoff else 0.0)
+        self.table.applyError(self.alpha * err, self.gamma * self.lam, self.eligibilityCutoff)
 
         self.updateCount += 1
 
     def getActionGreedily(self, state):
         # Get action based on best Q value
-        actions = []
-        #print("Available actions for state {}:".format(state))
-        for action in range(self.actionCount):
-            try:
-                q = self.QE[state, action][0]
-                actions.append(q)
-            except KeyError:
-                actions.append(0.0)
-        if len(actions) == 0:
+        choices = self.table.getBestActions(state)
+        if len(choices) == 0:
             return random.randint(0, self.actionCount - 1)
-        choices = [i for i, x in enumerate(actions) if x == max(actions)]
         choice = random.choice(choices)
         #print("\nChoosing action {}\n\n".format(choice))
         return choice
 
     def getAction(self, sense):
-        state = self.getStateFromSense(sense)
+        return self.getActionFromState(self.getStateFromSense(sense))
 
+    def getActionFromState(self, state):
         # Decide whether we act greedily or explore randomly based on epsilon
         randValue = random.random()
         action = 0
@@ -106,67 +564,105 @@ class SarsaMouse:
 
         return action
 
-    def getStateFromSense(self, sense):
-        foodMatrix = sense.food_smell
-        terrainSight = sense.elevation_sight
-        currentTerrain = terrainSight[2][2]
-        simplifiedTerrainSight = np.array([
-            [currentTerrain - getAvgOfSubMatrix(terrainSight, [0, 1], [0, 1]),
-             currentTerrain - getAvgOfSubMatrix(terrainSight, [0, 1], [2]),
-             currentTerrain - getAvgOfSubMatrix(terrainSight, [0, 1], [3, 4])],
-            [currentTerrain - getAvgOfSubMatrix(terrainSight, [2], [0, 1]), 0.,
-             currentTerrain - getAvgOfSubMatrix(terrainSight, [2], [3, 4])],
-            [currentTerrain - getAvgOfSubMatrix(terrainSight, [3, 4], [0, 1]),
-             currentTerrain - getAvgOfSubMatrix(terrainSight, [3, 4], [2]),
-             currentTerrain - getAvgOfSubMatrix(terrainSight, [3, 4], [3, 4])],
-        ])
-        terrainState = self.getStateFromMatrix(simplifiedTerrainSight, self.terrainSpace)
-
-        dangerSight = sense.danger_sight
-        simplifiedDangerSight = np.array([
-            [1. if np.float64(255.) in dangerSight[np.ix_([0, 2], [0, 2])] else 0.,
-             1. if np.float64(255.) in dangerSight[np.ix_([0, 2], [2, 4])] else 0.],
-            [1. if np.float64(255.) in dangerSight[np.ix_([2, 4], [0, 2])] else 0.,
-             1. if np.float64(255.) in dangerSight[np.ix_([2, 4], [2, 4])] else 0.],
-        ])
-        dangerState = self.getStateFromMatrix(simplifiedDangerSight, [0., 1.], False)
-
-        foodSight = sense.food_sight
-        simplifiedFoodSight = np.array([
-            [1. if np.float64(255.) in foodSight[np.ix_([0, 2], [0, 2])] else 0.,
-             1. if np.float64(255.) in foodSight[np.ix_([0, 2], [2, 4])] else 0.],
-            [1. if np.float64(255.) in foodSight[np.ix_([2, 4], [0, 2])] else 0.,
-             1. if np.float64(255.) in foodSight[np.ix_([2, 4], [2, 4])] else 0.],
-        ])
-        foodSightState = self.getStateFromMatrix(simplifiedFoodSight, [0., 1.], False)
-
-        simplifiedFoodSmell = np.array([
-            [getAvgOfSubMatrix(foodMatrix, [0, 1], [0, 1]), getAvgOfSubMatrix(foodMatrix, [0, 1], [1, 2])],
-            [getAvgOfSubMatrix(foodMatrix, [1, 2], [0, 1]), getAvgOfSubMatrix(foodMatrix, [1, 2], [1, 2])]
-        ])
-        foodSmellState = self.getStateFromMatrix(simplifiedFoodSmell, self.scentSpace, False)
+    def getActions(self, senses):
+        """ Picks an action for every sense in a batch, such as a StackedSense """
+        states = self.encoder.encodeBatch(senses)
+        return np.array([self.getActionFromState(state) for state in states])
 
-        return foodSightState, foodSmellState, dangerState, terrainState
+    def updateBatch(self, states, actions, statePrimes, actionPrimes, rewards, dones):
+        """ Applies one transition per world, in world order. The worlds share
+        the Q-table, but each has its own eligibility traces, so an error in
+        one world only changes the pairs visited in it.
+
+        For worlds that are done, the transition ends the episode: its
+        statePrime and actionPrime are ignored, nothing is bootstrapped, and
+        the world's traces are dropped. """
+        states = self.encoder.encodeBatch(states)
+        statePrimes = self.encoder.encodeBatch(statePrimes)
+        if len(self.worldTraces) != len(rewards):
+            self.worldTraces = [None] * len(rewards)
+        # Traces left by update() are put back afterwards
+        ownTraces = self.table.takeTraces()
+        for i in range(len(rewards)):
+            self.table.putTraces(self.worldTraces[i])
+            self.updateStates(states[i], int(actions[i]), statePrimes[i], int(actionPrimes[i]), rewards[i], dones[i])
+            traces = self.table.takeTraces()
+            self.worldTraces[i] = None if dones[i] else traces
+        self.table.putTraces(ownTraces)
+
+    def clearTraces(self):
+        """ Drops every eligibility trace, including the batched worlds' """
+        self.table.takeTraces()
+        self.worldTraces = []
+
+    def trackChanges(self):
+        """ Starts remembering which Q-values updates change. The traces are
+        cleared, so only pairs visited from now on can change. """
+        self.clearTraces()
+        self.touched = {}
+
+    def takeChanges(self):
+        """ Stops tracking changes. Returns (state, action, change) for every
+        Q-value that changed, and puts those Q-values back as they were. """
+        self.clearTraces()
+        changes = []
+        for (state, action), startQ in self.touched.items():
+            change = self.table.getQ(state, action) - startQ
+            if change != 0.0:
+                changes.append((state, action, change))
+                self.table.set(state, action, startQ, 0.0)
+        self.touched = None
+        return changes
+
+    def getStateFromSense(self, sense):
+        return self.encoder.encode(sense)
 
     def getStateFromMatrix(self, matrix, space, skipMiddle = True):
-        if skipMiddle and (matrix.shape[0] % 2 == 0 or matrix.shape[1] % 2 == 0):
-            print("Trying to skip middle value of an array with an even number of elements.")
-            exit(1)
-        sum = 0
-        count = 0
-        digit = 0
-        length = len(np.digitize(matrix, space).flat) - (2 if skipMiddle else 1)
-        middleIndex = int(matrix.shape[0] / 2) * matrix.shape[1] + int(matrix.shape[1] / 2)
-        for e in np.digitize(matrix, space).flat:
-            if skipMiddle and not count == middleIndex or not skipMiddle:  # ignore middle value because that's where our agent is
-                sum += (e - 1) * (len(space) - 1) ** (length - digit)
-                digit += 1
-            count += 1
-        return int(sum)
+        """ Reads the bins that a matrix's values fall in as the digits of one
+        number. Also takes a stack of matrices, and then returns an array with
+        the number of each. """
+        matrix = np.asarray(matrix)
+        rows, cols = matrix.shape[-2:]
+        if skipMiddle and (rows % 2 == 0 or cols % 2 == 0):
+            raise ValueError("Trying to skip middle value of an array with an even number of elements.")
+        key = (len(space) - 1, rows, cols, skipMiddle)
+        powers = self.radixPowers.get(key)
+        if powers is None:
+            powers = self.radixPowers[key] = getRadixPowers(*key)
+        # The middle value is skipped because that's where our agent is
+        digits = np.digitize(matrix, space).reshape(matrix.shape[:-2] + (rows * cols,)) - 1
+        codes = digits @ powers
+        if matrix.ndim == 2:
+            return int(codes)
+        return codes
 
     def save(self):
-        # Saves to json file
-        data = {
+        # Saves to a json file, or a binary checkpoint if the file name ends
+        # with BINARY_SAVE_EXTENSION
+        if self.saveFname is None:
+            return
+        try:
+            writeSave(self.saveFname, self.getSettings(), self.table)
+        except Exception as e:
+            print(e)
+
+    def snapshot(self):
+        # A copy of everything save() writes, that training can't change
+        return self.saveFname, self.getSettings(), self.table.copy()
+
+    def getStats(self):
+        # Counters about learning so far. The tables keep these up to date,
+        # so this never scans the table.
+        return {
+            "updates": self.updateCount,
+            "tableSize": len(self.table),
+            "nonzeroQ": self.table.nonzeroCount(),
+            "liveTraces": self.table.liveTraceCount(),
+        }
+
+    def getSettings(self):
+        # Everything that gets saved apart from the Q-table
+        return {
             "k": self.k + self.lastK,
             "alpha": self.alpha,
             "gamma": self.gamma,
@@ -178,17 +674,35 @@ class SarsaMouse:
             "possibleActions": self.actionCount,
             "scentSpace": self.scentSpace,
             "terrainSpace": self.terrainSpace,
-            "dataKeysState": [k[0] for k in self.QE.keys()],
-            "dataKeysAction": [k[1] for k in self.QE.keys()],
-            "dataValues": [v for v in self.QE.values()]
         }
-        try:
-            with open(MOUSE_SAVE_FNAME, 'w') as json_file:
-                json.dump(data, json_file)
-        except Exception as e:
-            print(e)
+
+    def getData(self):
+        # Everything that gets saved, in the format load() takes
+        return getSaveData(self.getSettings(), self.table)
 
     def load(self, data):
+        self.loadSettings(data)
+        qeKeysState = data["dataKeysState"]
+        qeKeysAction = data["dataKeysAction"]
+        qeValues = data["dataValues"]
+        self.table = self.qTableClass(self.actionCount)
+        self.worldTraces = []
+        for i in range(len(qeValues)):
+            keyAction = int(qeKeysAction[i])
+            keyState = tuple(qeKeysState[i])
+            q, e = qeValues[i]
+            self.table.set(keyState, keyAction, q, e)
+
+    def loadBinary(self, fname):
+        settings, arrays = readCheckpoint(fname)
+        # Checkpoints written before the counters were saved have none
+        counts = settings.pop("counts", None)
+        self.loadSettings(settings)
+        self.table = self.qTableClass(self.actionCount)
+        self.worldTraces = []
+        self.table.loadArrays(arrays, counts)
+
+    def loadSettings(self, data):
         self.k = data["k"]
         self.alpha = data["alpha"]
         self.gamma = data["gamma"]
@@ -200,14 +714,53 @@ class SarsaMouse:
         self.actionCount = data["possibleActions"]
         self.scentSpace = data["scentSpace"]
         self.terrainSpace = data["terrainSpace"]
-        qeKeysState = data["dataKeysState"]
-        qeKeysAction = data["dataKeysAction"]
-        qeValues = data["dataValues"]
-        for i in range(len(qeValues)):
-            keyAction = int(qeKeysAction[i])
-            keyState = tuple(qeKeysState[i])
-            value = tuple(qeValues[i])
-            self.QE[keyState, keyAction] = value
+        self.encoder = StateEncoder(self.scentSpace, self.terrainSpace, self.getStateFromMatrix)
+
+class AsyncCheckpointer:
+    """ Saves a SarsaMouse on a background thread, so training can keep going
+    while the file is written. save() only takes a snapshot of the mouse
+    before returning. """
+    def __init__(self, mouse, verbose=True):
+        self.mouse = mouse
+        self.verbose = verbose
+        self.thread = None
+        # Seconds spent taking the last snapshot (training is stopped), and
+        # from the last save() call until its file was in place.
+        self.lastSnapshotTime = None
+        self.lastLatency = None
+        self.saveCount = 0
+
+    def save(self):
+        if self.mouse.saveFname is None:
+            return
+        # Only one save is written at a time
+        self.wait()
+        start = time.perf_counter()
+        snapshot = self.mouse.snapshot()
+        self.lastSnapshotTime = time.perf_counter() - start
+        self.thread = threading.Thread(target=self.write, args=(snapshot, start))
+        self.thread.start()
+
+    def write(self, snapshot, start):
+        fname, settings, table = snapshot
+        try:
+            writeSave(fname, settings, table)
+        except Exception as e:
+            print(e)
+            return
+        self.lastLatency = time.perf_counter() - start
+        self.saveCount += 1
+        if self.verbose:
+            print("Saved {} in {:.3f}s ({:.3f}s snapshot)".format(fname, self.lastLatency, self.lastSnapshotTime))
+
+    def isSaving(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
 
 if __name__ == "__main__":
     mouse = SarsaMouse()
@@ -5,10 +5,14 @@ import sys
 from os import path
 from PIL import Image, ImageFilter
 from variable_config import *
+from instrumentation import PROFILER, timed
+from entity_store import EntityStore, StoreField
 #import time
 from enum import Enum
-from math import sqrt
+from math import ceil, sqrt
 from copy import deepcopy
+from collections import deque
+from operator import attrgetter
 #random.seed(99)
 
 # Initialize pygame.
@@ -17,11 +21,106 @@ from copy import deepcopy
 # Get the current path of the python file. Used to load a font resource.
 ABS_PATH = path.dirname(path.realpath(__file__))
 
+# How many tiles away from an agent it can see.
+SIGHT_DIST = 2
+
+# Health tints are rounded to steps of this many color levels, so only a few
+# tinted faces ever have to be made.
+HEALTH_TINT_STEP = 8
+
+# Height maps made from a seed are kept for reuse by later games. Once there
+# are this many, the oldest one is dropped.
+HEIGHT_MAP_CACHE_SIZE = 64
+height_map_cache = {}
+
+# Makes games use the height maps made before the noise was fixed, which are
+# a lattice of bumps instead of smooth hills. Only needed to replay old runs.
+LEGACY_HEIGHT_MAPS = False
+
+# Every plant starts with PLANT_START_ENERGY, grows one energy a round with
+# PLANT_GROWTH_RATE chance up to PLANT_MAX_ENERGY, and looks different in each
+# of PLANT_STAGES steps of PLANT_ENERGY_STEP energy. All plants share these.
+PLANT_GROWTH_RATE = 0.9
+PLANT_STAGES = 5
+PLANT_MAX_ENERGY = 100
+PLANT_START_ENERGY = 10
+PLANT_ENERGY_STEP = PLANT_MAX_ENERGY // PLANT_STAGES
+
 
 
 def fast_dist(x1,y1,x2,y2):
     return np.linalg.norm(np.array((x1,y1))-np.array((x2,y2)))
 
+def calc_smell_field(tiles_x,tiles_y,sources_x,sources_y,strengths):
+    """ Total smell of every source on every tile, in one batched operation.
+    Each source's smell is the same as with fast_dist, but the sums can
+    differ from adding them one at a time by rounding. """
+    tiles_x = np.asarray(tiles_x)
+    shape = tiles_x.shape
+    # One row per tile and one column per source, so every tile's sources
+    # are summed over contiguous memory. Worked out in place to keep from
+    # making more arrays of that size.
+    smell = tiles_x.reshape(-1,1) - np.asarray(sources_x, dtype=float)
+    dy = np.asarray(tiles_y).reshape(-1,1) - np.asarray(sources_y, dtype=float)
+    smell *= smell
+    dy *= dy
+    smell += dy
+    np.sqrt(smell, out=smell)
+    smell += 1
+    np.divide(0.5, smell, out=smell)
+    smell *= strengths
+    smell *= 255
+    return smell.sum(axis=1).reshape(shape)
+
+def calc_plant_stages(energy):
+    """ Growth stage of plants with the given energies, the first stage i
+    with energy <= i * PLANT_ENERGY_STEP, like Plant.energy2stage """
+    return np.clip(np.ceil(np.asarray(energy) / PLANT_ENERGY_STEP), 0, PLANT_STAGES).astype(int)
+
+def calc_height_map(width,height,rng=np.random,legacy=False):
+    """ A random elevation map of shape (width, height), with values from
+    20 to 255, made by blurring noise. Nothing is written to disk.
+
+    With legacy the old maps are made instead. Those handed the int64 noise
+    to PIL as an 8 bit image, which only read the low byte of every 8th
+    value, so they're blurred from a lattice of sparse peaks. """
+    noise = rng.randint(0,high=250, size=(width,height))
+    if legacy:
+        peaks = np.zeros(width*height, dtype=np.uint8)
+        peaks[::8] = noise.reshape(-1)[:len(peaks[::8])]
+        noise = peaks.reshape(width,height)
+    img = Image.fromarray(noise.astype(np.uint8)).filter(ImageFilter.GaussianBlur(1.2))
+    elevation_map = np.asarray(img).copy()
+    # Stretch the values to the range 20 to 255
+    elevation_map[...] = np.interp(elevation_map,[elevation_map.min(),elevation_map.max()],[20,255])
+    return elevation_map
+
+class TerrainPool:
+    """ A fixed set of height maps made ahead of time. Games given a pool
+    pick one of its maps instead of making a new one every episode. """
+    def __init__(self,size,base_seed=0,width=GAME_GRID_WIDTH,height=GAME_GRID_HEIGHT,legacy=LEGACY_HEIGHT_MAPS):
+        self.maps = []
+        for i in range(size):
+            elevation_map = calc_height_map(width,height,np.random.RandomState(base_seed+i),legacy)
+            # Shared between games, so it must never change
+            elevation_map.flags.writeable = False
+            self.maps.append(elevation_map)
+
+    def __len__(self):
+        return len(self.maps)
+
+    def pick(self,rng=random):
+        return rng.choice(self.maps)
+
+def swap_remove(objects,game_object):
+    """ Remove a game object from a list by moving the last object into its
+    place, using the object's list_index """
+    last = objects.pop()
+    if last is not game_object:
+        objects[game_object.list_index] = last
+        last.list_index = game_object.list_index
+    game_object.list_index = None
+
 def dir2offset(direction):
     difficulty_multiplier = 1
     x = 0
@@ -49,19 +148,146 @@ def dir2offset(direction):
         print("Invalid direction, staying still")
     return x, y, difficulty_multiplier
 
+# (x, y) offset of every move, in the order dir2offset numbers them
+MOVE_OFFSETS = np.array([dir2offset(move)[:2] for move in range(9)])
+
+
+class SpriteAtlas:
+    """ Loads each image from disk once and keeps the scaled and tinted
+    copies made from it, keyed by (image path, size, tints). Sprites are
+    shared between objects, so they must not be drawn on. """
+    def __init__(self):
+        self.images = {}
+        self.sprites = {}
+        self.known_paths = set()
+
+    def exists(self, img_path):
+        if img_path not in self.known_paths:
+            if not path.exists(img_path):
+                return False
+            self.known_paths.add(img_path)
+        return True
+
+    def getSprite(self, img_path, size, tints=()):
+        key = (img_path, size, tints)
+        sprite = self.sprites.get(key)
+        if sprite is None:
+            if tints:
+                sprite = self.getSprite(img_path, size).copy()
+                for color in tints:
+                    sprite.fill(color,special_flags=pg.BLEND_MIN)
+            else:
+                if img_path not in self.images:
+                    self.images[img_path] = pg.image.load(img_path)
+                sprite = pg.transform.scale(self.images[img_path],size)
+            self.sprites[key] = sprite
+        return sprite
+
+SPRITE_ATLAS = SpriteAtlas()
+
+
+# (name, dtype) of the attributes a GameManager keeps in its entity stores,
+# so the game can work on every plant or agent at once
+PLANT_STORE_FIELDS = (("x",np.int64),("y",np.int64),("energy",np.int64),("stage",np.int64))
+AGENT_STORE_FIELDS = (("x",np.int64),("y",np.int64),("energy",np.float64),("health",np.int64),
+                      ("id",np.int64),("evil",np.bool_))
+
+# Attributes saved by GameState, apart from the ones in the entity stores.
+# Objects are saved as tuples of these.
+PLANT_STATE_FIELDS = ("alive","img_path","img_stage")
+AGENT_STATE_FIELDS = ("max_energy","score","alive","type",
+                      "good_choice_chance","deltaEnergy","deltaDamage","movement_choice",
+                      "raw_img_path","img_path")
+SENSE_STATE_FIELDS = ("id","elevation_sight","food_sight","creature_sight","danger_sight",
+                      "food_smell","creature_smell")
+get_plant_state = attrgetter(*PLANT_STATE_FIELDS)
+get_agent_state = attrgetter(*AGENT_STATE_FIELDS)
+get_sense_state = attrgetter(*SENSE_STATE_FIELDS)
+get_slot = attrgetter("slot")
+get_good_choice_chance = attrgetter("good_choice_chance")
+
+def set_state(obj,fields,values):
+    for field, value in zip(fields,values):
+        setattr(obj,field,value)
+
 
 # A class that allows for the saving and restoring of the game.
 class GameState():
+    """ The simulation state of a game: which objects are in it, their
+    positions, energy, health and plant stages, the occupancy layers, the
+    terrain and the state of the game's random streams. Nothing that is only used
+    for drawing is saved. The attributes kept in the entity stores are saved
+    as copies of the stores' arrays.
+
+    The game never changes sense matrices or height maps in place, it only
+    replaces them, so those are saved by reference instead of copied. """
     def __init__(self, game_manager):
-        self.game_manager = game_manager.deepcopy()
+        grid = game_manager.grid
+        self.round = game_manager.round
+        self.main_agent = game_manager.main_agent
+        self.agents = list(game_manager.agents)
+        self.plants = list(game_manager.plants)
+        self.agent_store = game_manager.agent_store.getState()
+        self.plant_store = game_manager.plant_store.getState()
+        self.agent_states = [(get_agent_state(agent), tuple(agent.tints), get_sense_state(agent.sense))
+                             for agent in self.agents]
+        self.plant_states = [(get_plant_state(plant), tuple(plant.tints)) for plant in self.plants]
+        self.layers = (grid.plant_layer.copy(), grid.creature_layer.copy(), grid.danger_layer.copy(),
+                       grid.occupied_grid.copy())
+        self.free_tiles = (list(grid.free_tiles), list(grid.free_slot), grid.free_count)
+        self.dead_prey = list(game_manager.dead_prey)
+        self.elevation_map = grid.elevation_map
+        self.random_state = game_manager.rng.getstate()
+        self.np_random_state = game_manager.np_rng.get_state()
 
     def restore(self, game_manager):
-        game_manager = self.game_manager
+        """ Put the game back the way it was, in place """
+        grid = game_manager.grid
+        game_manager.round = self.round
+        game_manager.main_agent = self.main_agent
+        game_manager.agents[:] = self.agents
+        game_manager.agent_store.setState(self.agent_store)
+        game_manager.plant_store.setState(self.plant_store)
+        game_manager.dead_prey = dict.fromkeys(self.dead_prey)
+        for agent, (agent_state, tints, sense_state) in zip(self.agents, self.agent_states):
+            set_state(agent, AGENT_STATE_FIELDS, agent_state)
+            agent.tints = list(tints)
+            agent.img = None
+            set_state(agent.sense, SENSE_STATE_FIELDS, sense_state)
+            agent.sense.apply_sight_to_array()
+            agent.sense.apply_smell_to_array()
+            # The senses changed, so anything cached about them is stale
+            agent.sense.stamp += 1
+        for plant, (plant_state, tints) in zip(self.plants, self.plant_states):
+            set_state(plant, PLANT_STATE_FIELDS, plant_state)
+            plant.tints = list(tints)
+            plant.img = None
+        for layer, saved_layer in zip((grid.plant_layer, grid.creature_layer, grid.danger_layer, grid.occupied_grid),
+                                      self.layers):
+            layer[...] = saved_layer
+        grid.free_tiles = list(self.free_tiles[0])
+        grid.free_slot = list(self.free_tiles[1])
+        grid.free_count = self.free_tiles[2]
+        grid.rebuildTileIndex(self.agents + self.plants)
+        game_manager.indexObjects()
+        if grid.elevation_map is not self.elevation_map:
+            grid.elevation_map = self.elevation_map
+            grid.elevation_layer[grid.layer_interior] = self.elevation_map
+            grid.elevation_map_img = None
+        game_manager.rng.setstate(self.random_state)
+        game_manager.np_rng.set_state(self.np_random_state)
 
 # class SensoryMatrix:
 class GameObject:
     """ TODO: ADD DOCSTRING """
-    def __init__(self,x,y,raw_img_path=None,stage=None):
+    # The EntityStore the object is in and its slot there, if it's in one
+    store = None
+    slot = None
+
+    def __init__(self,x,y,raw_img_path=None,stage=None,rng=random):
+        # Random stream used for everything the object decides. Either the
+        # random module or a random.Random owned by the object's game.
+        self.rng = rng
         if raw_img_path == None:
             raw_img_path = path.join(ABS_PATH, "art_assets","ERROR")
         self.type = None
@@ -70,15 +296,13 @@ class GameObject:
         self.y = y
         self.stage = stage
         self.alive = True
+        # Where the object is in its GameManager's list of agents
+        self.list_index = None
+        self.img = None
+        self.tints = []
         self.calc_img_path(raw_img_path)
         self.loadImg(self.img_path)
         self.energy = 0    
-        self.max_energy = 100
-
-    def consume(self,energy):
-        self.energy += energy
-        if self.energy > self.max_energy:
-            self.energy = self.max_energy
 
     def deplete(self,energy):
         self.energy -= energy
@@ -89,16 +313,29 @@ class GameObject:
         self.alive = False
     
     def loadImg(self, img_path):
-        self.img = pg.image.load(img_path)
-        self.img = pg.transform.scale(self.img,(SQUARE_SIZE,SQUARE_SIZE))
-        self.img_rect = self.img.get_rect()
+        """ Set the image to show. Nothing is read from disk until the
+        object is first drawn, so headless games never load any images. """
+        self.img_path = img_path
+        self.img = None
+        self.tints = []
+
+    def tint(self, color):
+        """ Tint the current image by blending it with a color """
+        self.tints.append(tuple(color))
+        self.img = None
+
+    def getImg(self,size=SQUARE_SIZE):
+        if self.img is None or self.img.get_width() != size:
+            self.img = SPRITE_ATLAS.getSprite(self.img_path,(size,size),tuple(self.tints))
+            self.img_rect = self.img.get_rect()
+        return self.img
 
     def calc_img_path(self, raw_img_path):
         if self.stage is not None:
             img_path = f"{raw_img_path}{self.stage}.png"
         else:
             img_path = f"{raw_img_path}.png"
-        if path.exists(img_path):
+        if SPRITE_ATLAS.exists(img_path):
             self.img_path = img_path
         else:
             print(f"ERROR: FILE NOT FOUND ({img_path})")
@@ -113,55 +350,81 @@ class GameObject:
         """ Input a 3x3 matrix, pick a direction based on probabilities """
 
         movement_list = list(range(0,9))
-        movement = random.choices(movement_list,weights=movement_matrix.flatten().tolist())
+        movement = self.rng.choices(movement_list,weights=movement_matrix.flatten().tolist())
         return movement[0]
 
-    def draw(self,x,y,surface):
-        surface.blit(self.img, self.img_rect.move(x,y))
+    def draw(self,x,y,surface,size=SQUARE_SIZE):
+        surface.blit(self.getImg(size), self.img_rect.move(x,y))
 
 
 class Plant(GameObject):
-    def __init__(self,x=None, y=None):
+    x = StoreField()
+    y = StoreField()
+    energy = StoreField()
+    stage = StoreField()
+
+    def __init__(self,x=None, y=None, rng=random):
         self.stage = 1
         self.raw_img_path = path.join(ABS_PATH, "art_assets","plant_growth","plant")
-        super().__init__(x,y,self.raw_img_path,stage=self.stage)
-        # Probability of growth per round
-        self.growth_rate = 0.9
-        self.num_stages = 5
-        self.max_energy = 100
-        self.energy = 10
-        self.energy_steps = int(self.max_energy / self.num_stages)
+        super().__init__(x,y,self.raw_img_path,stage=self.stage,rng=rng)
+        # Stage the image was picked for
+        self.img_stage = self.stage
+        self.energy = PLANT_START_ENERGY
 
+    def respawn(self,x,y):
+        """ Start over as a new plant at XY """
+        self.x = x
+        self.y = y
+        self.alive = True
+        self.energy = PLANT_START_ENERGY
+        self.stage = 1
 
     def tick(self):
-        if random.random() < self.growth_rate:
+        if self.rng.random() < PLANT_GROWTH_RATE:
             self.grow()
+        self.stage = self.energy2stage()
 
-        new_stage = self.energy2stage()
-        if new_stage != self.stage:
-            self.stage = new_stage
+    def getImg(self,size=SQUARE_SIZE):
+        # Growing only changes the stage. The image catches up when drawn.
+        if self.img_stage != self.stage:
+            self.img_stage = self.stage
             self.calc_img_path(self.raw_img_path)
             self.loadImg(self.img_path)
-
+        return super().getImg(size)
 
     def grow(self):
         self.energy += 1
-        if self.energy > self.max_energy:
-            self.energy = self.max_energy
+        if self.energy > PLANT_MAX_ENERGY:
+            self.energy = PLANT_MAX_ENERGY
 
     # Calculate stage based on energy level:
     def energy2stage(self):
-        for i in range(self.num_stages+1):
-            if self.energy <= i * self.energy_steps:
-                return i
-        return i
+        return min(max(ceil(self.energy / PLANT_ENERGY_STEP), 0), PLANT_STAGES)
 
 
 class Agent(GameObject):
-    def __init__(self,x=None,y=None,raw_img_path=None):
+    x = StoreField()
+    y = StoreField()
+    energy = StoreField()
+    health = StoreField()
+    id = StoreField()
+    # Whether the type is 'evil', so senses can tell from the agent store
+    # which agents to smell
+    evil = StoreField()
+
+    @property
+    def type(self):
+        return self.__dict__["type"]
+
+    @type.setter
+    def type(self, value):
+        self.__dict__["type"] = value
+        self.evil = value == 'evil'
+
+    def __init__(self,x=None,y=None,raw_img_path=None,rng=random):
         if raw_img_path is None:
             self.raw_img_path = path.join(ABS_PATH, "art_assets","agent_faces","agent_faces_neutral")
-        super().__init__(x,y,self.raw_img_path)
+        super().__init__(x,y,self.raw_img_path,rng=rng)
         self.sense = AgentSense()
         self.movement_choice = 4
         self.max_energy = MAX_ENERGY
@@ -170,13 +433,35 @@ class Agent(GameObject):
         self.score = 0
         self.alive = True
         self.type = 'neutral'
-        self.id = random.randint(0,10000000)
+        self.id = self.rng.randint(0,10000000)
         self.sense.id = self.id
         self.good_choice_chance = DEFAULT_INTELLIGENCE
         self.score = 0
         self.deltaEnergy = 0
         self.deltaDamage = 0
 
+    def respawn(self,x,y):
+        """ Start over as a new agent at XY. Uses the random stream the same
+        way as making a new agent does. """
+        self.x = x
+        self.y = y
+        self.raw_img_path = path.join(ABS_PATH, "art_assets","agent_faces","agent_faces_neutral")
+        self.calc_img_path(self.raw_img_path)
+        self.loadImg(self.img_path)
+        self.sense.reset()
+        self.movement_choice = 4
+        self.max_energy = MAX_ENERGY
+        self.energy = self.max_energy
+        self.health = MAX_HEALTH
+        self.score = 0
+        self.alive = True
+        self.type = 'neutral'
+        self.id = self.rng.randint(0,10000000)
+        self.sense.id = self.id
+        self.good_choice_chance = DEFAULT_INTELLIGENCE
+        self.deltaEnergy = 0
+        self.deltaDamage = 0
+
     def consume(self,energy):
         self.energy += energy
         self.deltaEnergy += energy
@@ -201,16 +486,20 @@ class Agent(GameObject):
             self.heal()
 
     def choose_movement(self):
-        move = random.randint(0,8)
+        move = self.rng.randint(0,8)
 
-        if random.random() <= self.good_choice_chance:
-            smell_list = list(self.sense.food_smell.flatten())
+        if self.rng.random() <= self.good_choice_chance:
+            smell_list = list(self.target_smell().flatten())
             move = smell_list.index(max(smell_list))
             if sum(smell_list) < 100:
-                move = random.randint(0,8)
+                move = self.rng.randint(0,8)
 
         return move
 
+    def target_smell(self):
+        """ The smell the agent follows when it makes a good choice """
+        return self.sense.food_smell
+
     def move(self,x,y,difficulty):
         self.x = x
         self.y = y
@@ -230,7 +519,7 @@ class Agent(GameObject):
         blue = 0
         if self.type == 'evil':
             blue = 255
-        self.img.fill(pg.Color(255,0,blue,1),special_flags=pg.BLEND_MIN)
+        self.tint(pg.Color(255,0,blue,1))
         self.alive = 0
 
     def setType(self,new_type):
@@ -245,7 +534,8 @@ class Agent(GameObject):
         red_color =  int(255-(255 * (self.health/MAX_HEALTH)))
         if red_color < 0:
             red_color = 0
-        self.img.fill(pg.Color(255,255-red_color,255-red_color,1),special_flags=pg.BLEND_MIN)
+        red_color = min(255, round(red_color / HEALTH_TINT_STEP) * HEALTH_TINT_STEP)
+        self.tint(pg.Color(255,255-red_color,255-red_color,1))
 
 
     def take_damage(self, damage):
@@ -256,8 +546,8 @@ class Agent(GameObject):
         else:
             self.die()
     
-    def draw(self,x,y,surface):
-        surface.blit(self.img, self.img_rect.move(x,y))
+    def draw(self,x,y,surface,size=SQUARE_SIZE):
+        surface.blit(self.getImg(size), self.img_rect.move(x,y))
         if self.type == 'main':
             self.sense.draw(surface)
 
@@ -324,9 +614,10 @@ def drawGenericGrid(self,surface,rect,num_x,num_y):
 
 class AgentSense:
     def __init__(self):
-        self.sm_font = pg.font.Font(path.join(ABS_PATH,"Retron2000.ttf"), 11)
+        # Loaded the first time the sense is drawn
+        self.sm_font = None
 
-        self.sight_dist_from_agent = 2
+        self.sight_dist_from_agent = SIGHT_DIST
         self.smell_dist_from_agent = 1
 
         self.sight_range = self.sight_dist_from_agent * 2 + 1
@@ -340,6 +631,10 @@ class AgentSense:
 
 
         self.type = "neutral"
+
+        # Goes up every time the sense is updated, so code that caches
+        # something about the sense can tell when it changed.
+        self.stamp = 0
         
         for i in range(4):
             sight_rect = pg.Rect(
@@ -361,6 +656,12 @@ class AgentSense:
             self.smell_rects.append(smell_rect)
 
 
+    def reset(self):
+        """ Clear the senses for a new game """
+        self.reset_sight()
+        self.reset_smell()
+        self.stamp += 1
+
     def reset_sight(self):
         self.elevation_sight = np.zeros((self.sight_range,self.sight_range))
         self.food_sight = np.zeros((self.sight_range,self.sight_range))
@@ -386,6 +687,8 @@ class AgentSense:
         self.creature_smell = np.zeros((self.smell_range,self.smell_range))
 
     def draw(self, surface):
+        if self.sm_font is None:
+            self.sm_font = pg.font.Font(path.join(ABS_PATH,"Retron2000.ttf"), 11)
 
         surface.blit(self.sm_font.render(f"Terrain", 0, (255, 0, 0)), (10, WINDOW_HEIGHT - 80))
         surface.blit(self.sm_font.render(f"Food", 0, (255, 0, 0)), (80, WINDOW_HEIGHT - 80))
@@ -417,109 +720,180 @@ class AgentSense:
             #self.sight_senses[i] = np.fliplr(self.sight_senses[i])
             #self.sight_senses[i] = np.flipud(self.sight_senses[i])
         
-    def update(self,x,y,grid,agents,plants):
-        self.update_sight(x,y,grid,agents,plants)
-        self.update_smell(x,y,grid,agents,plants)
-        grid_loc_x = 0
-        for x_offset in range(-self.smell_dist_from_agent, self.smell_dist_from_agent+1):
-            grid_loc_y = 0
-            for y_offset in range(-self.smell_dist_from_agent, self.smell_dist_from_agent+1):
-                x_new = x + x_offset
-                y_new = y + y_offset
-                if grid.checkValidTile(x_new,y_new):
-                    for agent in agents:
-                        if agent.id != self.id:
-                            if not (self.type == 'evil' and agent.type == "evil"):
-                                self.creature_smell[grid_loc_y,grid_loc_x] += (0.5/(fast_dist(x_new,y_new,agent.x,agent.y)+1))*255
-
-                    for plant in plants:
-                        self.food_smell[grid_loc_y,grid_loc_x] += (0.5/(fast_dist(x_new,y_new,plant.x,plant.y)+1))*(plant.energy/plant.max_energy)*255
-
-                        
-                else:
-                    self.creature_smell[grid_loc_y,grid_loc_x] = 0
-                    self.food_smell[grid_loc_y,grid_loc_x] = 0
-                grid_loc_y += 1
-            grid_loc_x += 1
-        self.apply_smell_to_array()
-
-    def update_sight(self,x,y,grid,agents,plants):
-        self.reset_sight()
-        self.reset_smell()
-
-        grid_loc_x = 0
-        for x_offset in range(-self.sight_dist_from_agent, self.sight_dist_from_agent+1):
-            grid_loc_y = 0
-            for y_offset in range(-self.sight_dist_from_agent, self.sight_dist_from_agent+1):
-                x_new = x + x_offset
-                y_new = y + y_offset
-                if grid.checkValidTile(x_new,y_new):
-                    self.elevation_sight[grid_loc_y,grid_loc_x] = grid.elevation_map[x_new,y_new]
-                    self.creature_sight[grid_loc_y,grid_loc_x] = 128
-                    self.danger_sight[grid_loc_y,grid_loc_x] = 128
-                    self.food_sight[grid_loc_y,grid_loc_x] = 128
-
-                    for agent in agents:
-                        if agent.x == x_new and agent.y == y_new:
-                            self.creature_sight[grid_loc_y,grid_loc_x] = 255
-                            if agent.type == "evil":
-                                self.danger_sight[grid_loc_y,grid_loc_x] = 255
-
-                    for plant in plants:
-                        if plant.x == x_new and plant.y == y_new:
-                            self.food_sight[grid_loc_y,grid_loc_x] = 255
-
-                else:
-                    self.elevation_sight[grid_loc_y,grid_loc_x] = 255
-                    self.creature_sight[grid_loc_y,grid_loc_x] = 0
-                    self.danger_sight[grid_loc_y,grid_loc_x] = 0
-                    self.food_sight[grid_loc_y,grid_loc_x] = 0
-
-                grid_loc_y += 1
-            grid_loc_x += 1
-        #TODO: Cleanup this math
+    # The senses of an agent at XY, from the grid and the GameManager's
+    # entity stores
+    @timed("AgentSense.update")
+    def update(self,x,y,grid,agent_store,plant_store):
+        self.update_sight(x,y,grid)
+        self.update_smell(x,y,grid,agent_store,plant_store)
+        self.stamp += 1
+
+    def update_sight(self,x,y,grid):
+        # The grid's occupancy layers are padded by the sight distance, so the
+        # sight window is always a plain slice of them. Layers are indexed
+        # [x, y] while sight matrices are indexed [y, x].
+        window = grid.calcLayerWindow(x,y,self.sight_dist_from_agent)
+        valid = grid.valid_layer[window].T * 128.
+
+        self.elevation_sight = grid.elevation_layer[window].T.copy()
+        self.food_sight = np.where(grid.plant_layer[window].T > 0, 255., valid)
+        self.creature_sight = np.where(grid.creature_layer[window].T > 0, 255., valid)
+        self.danger_sight = np.where(grid.danger_layer[window].T > 0, 255., valid)
         self.apply_sight_to_array()
         #self.flip_matrices()
 
-    def update_smell(self,x,y,grid,agents,plants):
+    def update_smell(self,x,y,grid,agent_store,plant_store):
+        # Tile coordinates of the smell window, indexed [y, x] like the
+        # smell matrices.
+        offsets = np.arange(-self.smell_dist_from_agent, self.smell_dist_from_agent+1)
+        tiles_x, tiles_y = np.meshgrid(x + offsets, y + offsets)
+        valid = grid.checkValidTiles(tiles_x, tiles_y)
+
+        # Every agent but this one, and evil agents don't smell each other
+        smelled = agent_store.view("id") != self.id
+        if self.type == 'evil':
+            smelled &= ~agent_store.view("evil")
+        creature_smell = calc_smell_field(tiles_x, tiles_y,
+                                          agent_store.view("x")[smelled],
+                                          agent_store.view("y")[smelled],
+                                          1.)
+        food_smell = calc_smell_field(tiles_x, tiles_y,
+                                      plant_store.view("x"),
+                                      plant_store.view("y"),
+                                      plant_store.view("energy")/PLANT_MAX_ENERGY)
+
+        self.creature_smell = np.where(valid, creature_smell, 0.)
+        self.food_smell = np.where(valid, food_smell, 0.)
         self.apply_smell_to_array()
         
 class EvilAgent(Agent):
-    def __init__(self,x=None,y=None):
+    def __init__(self,x=None,y=None,rng=random):
         self.raw_img_path = path.join(ABS_PATH, "art_assets","agent_faces","agent_faces_evil")
-        super().__init__(x,y,self.raw_img_path)
-        self.img.fill(pg.Color("#AAAAFF"),special_flags=pg.BLEND_MIN)
+        super().__init__(x,y,self.raw_img_path,rng=rng)
+        self.tint(pg.Color("#AAAAFF"))
         self.type = 'evil'
         self.good_choice_chance = DEFAULT_EVIL_INTELLIGENCE
         self.sense.type = 'evil'
         self.max_energy = MAX_ENERGY * 2
         self.energy = self.max_energy
-    def choose_movement(self):
-
-        move = random.randint(0,8)
 
-        if random.random() <= self.good_choice_chance:
-            smell_list = list(self.sense.creature_smell.flatten())
-            move = smell_list.index(max(smell_list))
-            if sum(smell_list) < 100:
-                move = random.randint(0,8)
+    def respawn(self,x,y):
+        super().respawn(x,y)
+        self.raw_img_path = path.join(ABS_PATH, "art_assets","agent_faces","agent_faces_evil")
+        self.calc_img_path(self.raw_img_path)
+        self.loadImg(self.img_path)
+        self.tint(pg.Color("#AAAAFF"))
+        self.type = 'evil'
+        self.good_choice_chance = DEFAULT_EVIL_INTELLIGENCE
+        self.max_energy = MAX_ENERGY * 2
+        self.energy = self.max_energy
 
-        return move
+    def target_smell(self):
+        return self.sense.creature_smell
 
 class Grid:
-    def __init__(self,width,height):
+    def __init__(self,width,height,terrain_seed=None,terrain_pool=None,rng=random,np_rng=np.random):
+        # The grid is width tiles along x and height tiles along y. Arrays
+        # of tiles are indexed [x, y], so they have shape (width, height).
         self.width = width
         self.height = height
+        self.num_spaces = width * height
+        # Random streams for placing objects and for making height maps
+        self.rng = rng
+        self.np_rng = np_rng
         self.padding = 1
-        self.square_size = int(WINDOW_WIDTH/GAME_GRID_WIDTH*0.8)
+        # Tiles shrink so the longest side of the grid fits the window
+        self.square_size = max(1, int(WINDOW_WIDTH/max(width,height)*0.8))
         self.grid_padding = self.calcGridPadding()
         self.calcGridSize()
 
-        self.occupied_grid = np.zeros((GAME_GRID_WIDTH,GAME_GRID_HEIGHT))
-        
+        # Number of plants and agents on each tile
+        self.occupied_grid = np.zeros((width,height), dtype=int)
+        # The plants and the agents on each tile, keyed by (x, y). Tiles with
+        # nothing on them aren't in these.
+        self.plants_at = {}
+        self.agents_at = {}
+        # Tiles with nothing on them, so an empty tile can be picked in
+        # constant time. The first free_count entries of free_tiles are the
+        # flat indices (x*height + y) of the free tiles, in no order, and
+        # free_slot gives where each tile is in free_tiles.
+        self.resetFreeTiles()
+
+        # Number of plants, creatures and evil creatures on each tile. Like the
+        # elevation map, layers are indexed [x, y], and they're padded by the
+        # sight distance so that sight windows never need bounds checks.
+        self.layer_padding = SIGHT_DIST
+        layer_shape = (width + 2*self.layer_padding, height + 2*self.layer_padding)
+        self.layer_interior = (slice(self.layer_padding, self.layer_padding + width),
+                               slice(self.layer_padding, self.layer_padding + height))
+        self.plant_layer = np.zeros(layer_shape, dtype=int)
+        self.creature_layer = np.zeros(layer_shape, dtype=int)
+        self.danger_layer = np.zeros(layer_shape, dtype=int)
+        # 1 on tiles inside the grid, 0 on the padding
+        self.valid_layer = np.zeros(layer_shape)
+        self.valid_layer[self.layer_interior] = 1
+        # Filled in once the height map is calculated. Padding reads as 255.
+        self.elevation_layer = np.full(layer_shape, 255.)
+
         self.default_color = pg.Color("#FFFFFF")
         self.line_color = pg.Color("#010101")
-        self.calcHeightMap()
+        self.terrain_pool = terrain_pool
+        self.calcHeightMap(terrain_seed)
+
+    def reset(self,terrain_seed=None,keep_terrain=False):
+        """ Empty the grid for a new game, keeping its arrays """
+        self.occupied_grid[...] = 0
+        self.resetFreeTiles()
+        self.plants_at.clear()
+        self.agents_at.clear()
+        self.plant_layer[...] = 0
+        self.creature_layer[...] = 0
+        self.danger_layer[...] = 0
+        if not keep_terrain:
+            self.calcHeightMap(terrain_seed)
+
+    def resetFreeTiles(self):
+        self.free_tiles = list(range(self.num_spaces))
+        self.free_slot = list(range(self.num_spaces))
+        self.free_count = self.num_spaces
+
+    def getPlantsAt(self,x,y):
+        return list(self.plants_at.get((x,y), ()))
+
+    def getAgentsAt(self,x,y):
+        return list(self.agents_at.get((x,y), ()))
+
+    def rebuildTileIndex(self,game_objects):
+        self.plants_at.clear()
+        self.agents_at.clear()
+        for game_object in game_objects:
+            self.changeTileIndex(game_object,game_object.x,game_object.y,1)
+
+    def rebuildOccupancy(self,game_objects):
+        """ Work out every occupancy structure again from the objects on
+        the grid """
+        self.reset(keep_terrain=True)
+        for game_object in game_objects:
+            self.addOccupant(game_object)
+
+    # Swap a tile with the last free tile, then drop it off the end
+    def takeFreeTile(self,tile):
+        slot = self.free_slot[tile]
+        self.free_count -= 1
+        last = self.free_tiles[self.free_count]
+        self.free_tiles[slot] = last
+        self.free_slot[last] = slot
+        self.free_tiles[self.free_count] = tile
+        self.free_slot[tile] = self.free_count
+
+    def releaseFreeTile(self,tile):
+        slot = self.free_slot[tile]
+        first_taken = self.free_tiles[self.free_count]
+        self.free_tiles[slot] = first_taken
+        self.free_slot[first_taken] = slot
+        self.free_tiles[self.free_count] = tile
+        self.free_slot[tile] = self.free_count
+        self.free_count += 1
 
     def calcRandNearby(self,x,y,rand_range):
         rand_range = rand_range * 2
@@ -527,7 +901,7 @@ class Grid:
         empty_range = self.checkEmptyInRange(x,y,rand_range)
         if empty_range == []:
             return None, None
-        tuple = random.choice(empty_range)
+        tuple = self.rng.choice(empty_range)
         return tuple[0], tuple[1]
 
     def checkEmptyInRange(self,x,y,rand_range):
@@ -542,72 +916,109 @@ class Grid:
     # Check to make sure a given XY set is 
     def checkValidTile(self,x,y):
         if x >= 0 and y >= 0:
-            if x < GAME_GRID_WIDTH and y < GAME_GRID_HEIGHT:
+            if x < self.width and y < self.height:
                 return True
         return False
 
-    def calcHeightMap(self):
-        self.elevation_map = np.random.randint(0,high=250, size=(GAME_GRID_WIDTH,GAME_GRID_HEIGHT))
-        img_path = path.join(ABS_PATH,"height.png")
-        img = Image.fromarray(self.elevation_map, mode='L').filter(ImageFilter.GaussianBlur(1.2))
-        img.save(img_path)
-        self.elevation_map = np.asarray(Image.open(img_path)).copy()
-        arr_max = self.elevation_map.max()
-        arr_min = self.elevation_map.min()
-
-        for x in range(GAME_GRID_WIDTH):
-            for y in range(GAME_GRID_HEIGHT):
-                val = np.interp(self.elevation_map[x][y],[arr_min,arr_max],[20,255])
-                self.elevation_map[x,y] = val
-
-        img = Image.fromarray(self.elevation_map).convert('L')
-        img.save(img_path)
-        
-        elevation_map_img = pg.image.load(img_path)
-        
+    # Slices of the occupancy layers that cover every tile within dist of XY
+    def calcLayerWindow(self,x,y,dist):
+        x += self.layer_padding
+        y += self.layer_padding
+        return slice(x - dist, x + dist + 1), slice(y - dist, y + dist + 1)
+
+    # Keep the occupancy layers up to date as objects appear, move and leave.
+    def addOccupant(self,game_object):
+        self.changeOccupancy(game_object,game_object.x,game_object.y,1)
+
+    def removeOccupant(self,game_object):
+        self.changeOccupancy(game_object,game_object.x,game_object.y,-1)
+
+    def moveOccupant(self,game_object,x,y):
+        self.changeOccupancy(game_object,game_object.x,game_object.y,-1)
+        self.changeOccupancy(game_object,x,y,1)
+
+    def changeTileIndex(self,game_object,x,y,amount):
+        objects_at = self.plants_at if isinstance(game_object, Plant) else self.agents_at
+        if amount > 0:
+            objects_at.setdefault((x,y), []).append(game_object)
+        else:
+            objects = objects_at[x,y]
+            objects.remove(game_object)
+            if not objects:
+                del objects_at[x,y]
+
+    def changeOccupancy(self,game_object,x,y,amount):
+        self.changeTileIndex(game_object,x,y,amount)
+        count = self.occupied_grid[x,y]
+        self.occupied_grid[x,y] = count + amount
+        if count == 0:
+            self.takeFreeTile(x*self.height + y)
+        elif count + amount == 0:
+            self.releaseFreeTile(x*self.height + y)
+
+        x += self.layer_padding
+        y += self.layer_padding
+        if isinstance(game_object, Plant):
+            self.plant_layer[x,y] += amount
+        else:
+            self.creature_layer[x,y] += amount
+            if game_object.type == 'evil':
+                self.danger_layer[x,y] += amount
+
+    # Same as checkValidTile, for arrays of XY coordinates
+    def checkValidTiles(self,xs,ys):
+        return (xs >= 0) & (ys >= 0) & (xs < self.width) & (ys < self.height)
+
+    # Without a seed the map is picked from the terrain pool, or made from the
+    # grid's numpy random stream if there's no pool. Maps made from a seed are
+    # cached, so games with the same seed share terrain.
+    def calcHeightMap(self,seed=None):
+        if seed is None and self.terrain_pool is not None:
+            self.elevation_map = self.terrain_pool.pick(self.rng)
+        elif seed is None:
+            self.elevation_map = calc_height_map(self.width,self.height,self.np_rng,LEGACY_HEIGHT_MAPS)
+        else:
+            key = (seed,self.width,self.height,LEGACY_HEIGHT_MAPS)
+            if key not in height_map_cache:
+                if len(height_map_cache) >= HEIGHT_MAP_CACHE_SIZE:
+                    del height_map_cache[next(iter(height_map_cache))]
+                height_map_cache[key] = calc_height_map(self.width,self.height,np.random.RandomState(seed),LEGACY_HEIGHT_MAPS)
+                # Shared between games, so it must never change
+                height_map_cache[key].flags.writeable = False
+            self.elevation_map = height_map_cache[key]
+        self.elevation_layer[self.layer_interior] = self.elevation_map
+
+        # Built from the elevation map the first time the grid is drawn
+        self.elevation_map_img = None
+
+    def calcElevationMapImg(self):
+        # Surface pixels are indexed [x, y], the same as the elevation map.
+        gray = np.repeat(self.elevation_map[:, :, np.newaxis], 3, axis=2)
+        elevation_map_img = pg.surfarray.make_surface(gray)
         self.elevation_map_img = pg.transform.scale(elevation_map_img,(self.total_x,self.total_y))
-        self.elevation_map_img = pg.transform.rotate(self.elevation_map_img,90)
-        self.elevation_map_img = pg.transform.flip(self.elevation_map_img,0,1)
 
     # Get a random valid X coordinate.
     def randGridX(self):
-        return random.randint(0,GAME_GRID_WIDTH-1)
+        return self.rng.randint(0,self.width-1)
 
     # Get a random valid Y coordinate.
     def randGridY(self):
-        return random.randint(0,GAME_GRID_HEIGHT-1)
+        return self.rng.randint(0,self.height-1)
 
     # Get a random valid XY coordinate set.
     def randGridSpace(self):
         return self.randGridX(), self.randGridY()
 
-    # Efficiently get a random XY pair that isn't already used. 
+    # Efficiently get a random XY pair that isn't already used. Takes the same
+    # time however full the grid is.
+    @timed("randEmptySpace")
     def randEmptySpace(self):
-        if np.count_nonzero(self.occupied_grid) < NUM_SPACES*0.5:
-            found = False
-            while found == False:
-                x,y = self.randGridSpace()
-                if self.occupied_grid[x][y] == 0:
-                    found = True
-            return x,y 
-        else:
-            empty_left = NUM_SPACES-len(np.count_nonzero(self.occupied_grid))
-            choice = random.randint(0,empty_left)
-            count = 0
-            for i in range(self.height):
-                for j in range(self.width):
-                    if self.occupied_grid[i][j] == 0:
-                        if count >= choice:
-                            return i,j
-                        count += 1
-            for i in range(self.height):
-                for j in range(self.width):
-                    if self.occupied_grid[i][j] == 0:
-                        if count >= choice:
-                            return i,j
-                        count += 1
+        if self.free_count == 0:
             print("ERROR: No spaces available")
             exit(9)
+        tile = self.free_tiles[self.rng.randrange(self.free_count)]
+        x, y = divmod(tile, self.height)
+        return x,y
 
     # Calculate the amount of padding needed for the current grid.
     def calcGridPadding(self):
@@ -647,7 +1058,7 @@ class Grid:
     # Draw the grid without anything else.
     def drawGrid(self,surface):
         grid_pos_x = self.padding + self.grid_padding
-        for i in range(self.height + 1):
+        for i in range(self.width + 1):
             pg.draw.rect(
                         surface,
                         self.line_color,
@@ -661,7 +1072,7 @@ class Grid:
 
         grid_pos_y = self.padding + self.grid_padding
 
-        for i in range(self.width + 1):
+        for i in range(self.height + 1):
             pg.draw.rect(
                         surface,
                         self.line_color,
@@ -677,7 +1088,9 @@ class Grid:
     def draw(self, surface):
         x = self.padding + self.grid_padding
         y = self.padding + self.grid_padding
-        
+
+        if self.elevation_map_img is None:
+            self.calcElevationMapImg()
         rect = self.elevation_map_img.get_rect().move((x,y))
         surface.blit(self.elevation_map_img, rect)
 
@@ -685,37 +1098,126 @@ class Grid:
         self.drawGrid(surface)
 
 class GameManager:
-    """ A class that controls the logic and graphics of the game. """
-    def __init__(self,width,height, round):
-        self.grid = Grid(height, width)
+    """ A class that controls the logic and graphics of the game.
+
+    A headless game never draws, so no images, fonts or surfaces are ever
+    created and pygame doesn't need to be initialized.
+
+    A game made with a seed has its own random streams, so it plays out the
+    same every time it's given the same moves. Without a seed it uses the
+    random and numpy.random modules. """
+    def __init__(self,width,height, round, headless=False, terrain_seed=None, terrain_pool=None, seed=None):
+        if seed is None:
+            self.rng = random
+            self.np_rng = np.random
+        else:
+            self.rng = random.Random(seed)
+            self.np_rng = np.random.RandomState(seed)
+        self.grid = Grid(width, height, terrain_seed, terrain_pool, self.rng, self.np_rng)
+        # Dead herbivores, in the order they died. Evil agents eat them
+        # wherever they are.
+        self.dead_prey = {}
+        # Grids of other sizes get the same amount of food per tile as the
+        # configured one.
+        if self.grid.num_spaces == NUM_SPACES:
+            self.num_food = MAX_NUM_FOOD_ON_GRID
+        else:
+            self.num_food = max(1, int(MAX_NUM_FOOD_ON_GRID * self.grid.num_spaces / NUM_SPACES))
+        # Positions, energy, health and plant stages live in these, one slot
+        # per agent or plant on the grid. The plants are kept in slot order;
+        # agents is the order agents take their turns in.
+        self.agent_store = EntityStore(AGENT_STORE_FIELDS)
+        self.plant_store = EntityStore(PLANT_STORE_FIELDS)
         self.agents = []
-        self.plants = []
+        self.plants = self.plant_store.objects
 
         self.round = round
-
-        self.addAgent()
-        self.font = pg.font.Font(path.join(ABS_PATH,"Retron2000.ttf"), 12)
-
+        self.headless = headless
+        # Loaded the first time the game is drawn
+        self.font = None
+        # The most recent states saved with saveState
+        self.saved_states = deque(maxlen=MAX_SAVED_GAME_STATES)
+
+        self.populate()
+
+    def populate(self,spare_agents=(),spare_evil_agents=(),spare_plants=()):
+        """ Place the starting agents and plants, reusing spare objects
+        before making new ones """
+        spare_agents = list(spare_agents)
+        spare_evil_agents = list(spare_evil_agents)
+        spare_plants = list(spare_plants)
+
+        self.addAgent(spare_agents)
         self.agents[0].setType("main")
         self.main_agent = self.agents[0]
         for i in range(NUM_EVIL):
-            self.addEvilAgent()
+            self.addEvilAgent(spare_evil_agents)
         for i in range(NUM_AGENTS-1):
-            self.addAgent()
+            self.addAgent(spare_agents)
     
-        for i in range(MAX_NUM_FOOD_ON_GRID):
-            self.addPlant()
+        for i in range(self.num_food):
+            self.addPlant(spare_plants)
+
+    def reset(self,round,terrain_seed=None,keep_terrain=False,seed=None):
+        """ Start a new game in place. The grid's arrays, the agents and the
+        plants of the old game are reused and no assets are loaded. Random
+        numbers are drawn in the same order as when making a new
+        GameManager, so the new game is the same as a newly made one. A
+        seed gives the game new random streams made from it. """
+        if seed is not None:
+            self.seed(seed)
+        self.round = round
+        self.saved_states.clear()
+        self.grid.reset(terrain_seed, keep_terrain)
+        # The main agent goes first so it stays the main agent.
+        spare_agents = [agent for agent in self.agents if not isinstance(agent, EvilAgent) and agent is not self.main_agent]
+        spare_agents.append(self.main_agent)
+        spare_evil_agents = [agent for agent in self.agents if isinstance(agent, EvilAgent)]
+        spare_plants = list(self.plants)
+        self.agent_store.clear()
+        self.plant_store.clear()
+        self.agents = []
+        self.dead_prey = {}
+        self.populate(spare_agents, spare_evil_agents, spare_plants)
         
+    def seed(self,seed):
+        """ Give the game its own random streams, made from seed """
+        self.rng = random.Random(seed)
+        self.np_rng = np.random.RandomState(seed)
+        self.grid.rng = self.rng
+        self.grid.np_rng = self.np_rng
+        for game_object in self.agents + self.plants:
+            game_object.rng = self.rng
+
+    def saveState(self):
+        """ Save the state of the game. Only the last MAX_SAVED_GAME_STATES
+        states are kept. """
+        state = GameState(self)
+        self.saved_states.append(state)
+        return state
+
+    def restoreState(self,state=None):
+        """ Go back to a saved state, by default the most recent one. The
+        state stays saved, so the game can go back to it again. """
+        if state is None:
+            state = self.saved_states[-1]
+        state.restore(self)
+
+    @timed("draw")
     def draw(self,game_window, mouse):
+        if self.headless:
+            return
+        if self.font is None:
+            self.font = pg.font.Font(path.join(ABS_PATH,"Retron2000.ttf"), 12)
         self.grid.draw(game_window)
         # Draw plants
         for plant in self.plants:
             world_x, world_y = self.grid.calcXYLocation(plant.x,plant.y)
-            plant.draw(world_x, world_y, game_window)
+            plant.draw(world_x, world_y, game_window, self.grid.square_size)
 
         for agent in self.agents:
                 world_x, world_y = self.grid.calcXYLocation(agent.x,agent.y)
-                agent.draw(world_x, world_y, game_window)
+                agent.draw(world_x, world_y, game_window, self.grid.square_size)
         
         
         labels_y_start = 500
@@ -728,96 +1230,189 @@ class GameManager:
         game_window.blit(self.font.render(f"mouse updates:   {mouse.updateCount}", 0, (255, 0, 0)), (10, labels_y_start + 90))
         game_window.blit(self.font.render(f"mouse episodes completed:   {mouse.episodeCount + self.round}", 0, (255, 0, 0)), (10, labels_y_start + 105))
 
+    # Grows every plant at once, in place in the plant store.
+    # Images follow the new stages when the plants are next drawn.
+    @timed("plantTick")
     def plantTick(self):
-        for plant in self.plants:
-            plant.tick()
-
-    def agentTick(self,agent,move=None):
+        store = self.plant_store
+        if not store.count:
+            return
+        energy = store.view("energy")
+        energy += self.np_rng.random_sample(store.count) < PLANT_GROWTH_RATE
+        np.minimum(energy, PLANT_MAX_ENERGY, out=energy)
+        store.view("stage")[...] = calc_plant_stages(energy)
+
+    # Where each agent ends up with its move and the energy that costs, worked
+    # out for all of them at once from the agent store. None for agents whose
+    # move would leave the grid. Agents only move on their own turn, so this
+    # can be done before any of them moves.
+    @timed("calcMoveTargets")
+    def calcMoveTargets(self,agents,moves):
+        moves = np.asarray(moves, dtype=int)
+        invalid = (moves < 0) | (moves > 8)
+        if invalid.any():
+            print("Invalid direction, staying still")
+            moves = np.where(invalid, 4, moves)
+        slots = np.fromiter(map(get_slot, agents), int, len(agents))
+        xs = self.agent_store.arrays["x"][slots]
+        ys = self.agent_store.arrays["y"][slots]
+        new_xs = xs + MOVE_OFFSETS[moves,0]
+        new_ys = ys + MOVE_OFFSETS[moves,1]
+        valid = self.grid.checkValidTiles(new_xs,new_ys)
+        new_xs = np.where(valid, new_xs, xs)
+        new_ys = np.where(valid, new_ys, ys)
+        elevation_map = self.grid.elevation_map
+        diff_add = (elevation_map[new_xs,new_ys].astype(int) - elevation_map[xs,ys].astype(int))/255
+        costs = DEFAULT_TERRAIN_DIFFICULTY + diff_add
+        return [target if is_valid else None
+                for target, is_valid in zip(zip(new_xs.tolist(), new_ys.tolist(), costs.tolist()), valid.tolist())]
+
+    @timed("agentTick")
+    def agentTick(self,agent,move=None,target=None):
+        """ One agent's turn. target is the agent's entry from
+        calcMoveTargets for the move, if it was already worked out. """
         if agent.alive == 0:
             return
         agent.tick()
+        self.noteDeath(agent)
         if move == None:
             move = agent.choose_movement()
+        if target is None:
+            target = self.calcMoveTargets([agent],[move])[0]
 
-        offset_x, offset_y, difficulty = dir2offset(move)
-        new_x = agent.x + offset_x
-        new_y = agent.y + offset_y
-        
-        if self.grid.checkValidTile(new_x, new_y):
-            curr_height = self.grid.elevation_map[agent.x][agent.y]
-            new_height = self.grid.elevation_map[new_x][new_y]
-            difficulty = 1
-            diff_add = (int(new_height) - int(curr_height))/255
-
-            difficulty = DEFAULT_TERRAIN_DIFFICULTY + diff_add
-            #TODO Finish this
-
+        if target is not None:
+            new_x, new_y, difficulty = target
+            self.grid.moveOccupant(agent,new_x,new_y)
             agent.move(new_x,new_y,difficulty)
 
         if agent.type != 'evil':
-            for plant in self.plants:
-                if agent.x == plant.x and agent.y == plant.y:
-                        if EAT_PLANT_INSTANT:
-                            agent.consume(plant.energy)
-                            self.plants.remove(plant)
-                            self.addPlant()
-
-                        else:
-                            agent.consume(10)
-                            if plant.energy > 10:
-                                plant.deplete(10)
-                            else:
-                                self.plants.remove(plant)
-                                self.addPlant()
+            for plant in self.grid.getPlantsAt(agent.x, agent.y):
+                if EAT_PLANT_INSTANT:
+                    agent.consume(plant.energy)
+                    self.removePlant(plant)
+                    self.addPlant()
+                    PROFILER.count("plants_respawned")
 
-        else:
-            for target_agent in self.agents:
-                if target_agent.type != 'evil':
-                    if target_agent.alive:
-                        if agent.x == target_agent.x and agent.y == target_agent.y:
-                            target_agent.take_damage(10)
-                            
+                else:
+                    agent.consume(10)
+                    if plant.energy > 10:
+                        plant.deplete(10)
                     else:
-                        if target_agent.energy > 10:
-                            agent.consume(10)
-                            target_agent.deplete(10)
-                        else:
-                            agent.consume(target_agent.energy)
-                            self.agents.remove(target_agent)
+                        self.removePlant(plant)
+                        self.addPlant()
+                        PROFILER.count("plants_respawned")
+
+        else:
+            # Prey killed by this attack are only eaten from the next turn on,
+            # so the dead are eaten first.
+            for target_agent in list(self.dead_prey):
+                if target_agent.energy > 10:
+                    agent.consume(10)
+                    target_agent.deplete(10)
+                else:
+                    agent.consume(target_agent.energy)
+                    self.removeAgent(target_agent)
+            for target_agent in self.grid.getAgentsAt(agent.x, agent.y):
+                if target_agent.type != 'evil' and target_agent.alive:
+                    target_agent.take_damage(10)
+                    self.noteDeath(target_agent)
 
-        agent.sense.update(agent.x,agent.y,self.grid,self.agents,self.plants)
+        agent.sense.update(agent.x,agent.y,self.grid,self.agent_store,self.plant_store)
 
+    @timed("logicTick")
     def logicTick(self,player_move=None):
-        random.shuffle(self.plants)
-        random.shuffle(self.agents)
+        self.rng.shuffle(self.agents)
+        self.indexObjects()
         self.plantTick()
         
-        for agent in self.agents:
-            if agent.type != "main":
-                self.agentTick(agent)
-        for agent in self.agents:
+        # Agents can be removed during the turn, so go over a copy
+        agents = list(self.agents)
+        # Senses only change on an agent's own turn, so every computer
+        # controlled agent can pick its move before any of them moves.
+        npcs = [agent for agent in agents if agent.type != "main"]
+        if npcs:
+            moves = self.chooseMovements(npcs)
+            for agent, move, target in zip(npcs, moves, self.calcMoveTargets(npcs, moves)):
+                self.agentTick(agent,move,target)
+        for agent in agents:
             if agent.type == "main":
                 self.agentTick(agent,player_move)
+
+    @timed("chooseMovements")
+    def chooseMovements(self,agents):
+        """ choose_movement for many agents in one batch. Each agent moves
+        randomly, or with its good_choice_chance towards the strongest smell
+        it follows, unless that smell adds up to less than 100. """
+        if not agents:
+            return []
+        count = len(agents)
+        chances = np.fromiter(map(get_good_choice_chance, agents), float, count)
+        moves = self.np_rng.randint(0,9,count)
+        # Only the smells of agents that make a good choice are looked at
+        good = np.flatnonzero(self.np_rng.random_sample(count) <= chances)
+        if len(good):
+            smells = np.stack([agents[i].target_smell() for i in good.tolist()]).reshape(len(good),-1)
+            strong = smells.sum(axis=1) >= 100
+            moves[good[strong]] = smells[strong].argmax(axis=1)
+        return moves.tolist()
+
+    def indexObjects(self):
+        for i, agent in enumerate(self.agents):
+            agent.list_index = i
+
+    def noteDeath(self,agent):
+        if not agent.alive and agent.type != 'evil':
+            self.dead_prey[agent] = None
         
-    def addPlant(self):
+    def addPlant(self,spares=None):
         x, y = self.grid.randEmptySpace()
-        plant = Plant(x,y)
-        self.plants.append(plant)
+        if spares:
+            plant = spares.pop()
+            plant.rng = self.rng
+            plant.respawn(x,y)
+        else:
+            plant = Plant(x,y,rng=self.rng)
+        self.plant_store.attach(plant)
+        self.grid.addOccupant(plant)
+
+    def removePlant(self,plant):
+        self.grid.removeOccupant(plant)
+        self.plant_store.detach(plant)
 
-    def addAgent(self):
+    def addAgent(self,spares=None):
         x, y = self.grid.randEmptySpace()
-        agent = Agent(x,y)
+        if spares:
+            agent = spares.pop()
+            agent.rng = self.rng
+            agent.respawn(x,y)
+        else:
+            agent = Agent(x,y,rng=self.rng)
+        agent.list_index = len(self.agents)
         self.agents.append(agent)
+        self.agent_store.attach(agent)
+        self.grid.addOccupant(agent)
 
-    def addEvilAgent(self):
+    def addEvilAgent(self,spares=None):
         x, y = self.grid.randEmptySpace()
-        agent = EvilAgent(x,y)
+        if spares:
+            agent = spares.pop()
+            agent.rng = self.rng
+            agent.respawn(x,y)
+        else:
+            agent = EvilAgent(x,y,rng=self.rng)
+        agent.list_index = len(self.agents)
         self.agents.append(agent)
+        self.agent_store.attach(agent)
+        self.grid.addOccupant(agent)
+
+    def removeAgent(self,agent):
+        swap_remove(self.agents,agent)
+        self.dead_prey.pop(agent, None)
+        self.grid.removeOccupant(agent)
+        self.agent_store.detach(agent)
 
     def setOccupiedGrid(self):
-        self.grid.occupied_grid = np.zeros((GAME_GRID_WIDTH,GAME_GRID_HEIGHT))
-        for plant in self.plants:
-            self.grid.occupied_grid[plant.x][plant.y] = 1
+        self.grid.rebuildOccupancy(self.agents + self.plants)
 
 
 # All simple mouse does is pick a random direction, and moves there.
@@ -1,6 +1,7 @@
 from simulation_framework import *
 import pygame as pg
-from sarsamouse import SarsaMouse
+from sarsamouse import SarsaMouse, AsyncCheckpointer
+from instrumentation import PROFILER
 import pickle
 
 # Used to determine how many frames are skipped.
@@ -11,17 +12,55 @@ SKIP_FRAMES = 0
 # Number of frames to draw per second.
 FRAMES_PER_SECOND = 5
 
-pg.init()
+# Runs the simulation without a window. Nothing is drawn, and no images or
+# fonts are ever loaded, so this works on machines without a display.
+HEADLESS = False
+
+# Runs the game logic as fast as possible instead of at FRAMES_PER_SECOND.
+# Only every RENDER_EVERY_N_EPISODES-th episode is drawn (0 never draws), and
+# the W key toggles watching every episode at normal speed.
+TRAINING_MODE = False
+RENDER_EVERY_N_EPISODES = 100
+
+# While training without drawing, key presses are only checked after this
+# many logic steps.
+EVENT_POLL_INTERVAL = 50
+
+# Set to a number to make every episode replayable: episode k is played with
+# its own random streams seeded with SEED + k. None uses the random module.
+SEED = None
+
+# Times the game and agent hot paths and prints a summary every
+# PROFILE_SUMMARY_INTERVAL episodes. The B key prints it too.
+PROFILE = False
+PROFILE_SUMMARY_INTERVAL = 100
 
 number_of_episodes = 20000
 autosave_interval = 10  # Saves agent after this many episodes
 agent = SarsaMouse()
-game_window = pg.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
-game_window.fill(BACKGROUND_COLOR)
-pg.display.set_caption('Simulation')
+# Autosaves are written in the background while training continues
+checkpointer = AsyncCheckpointer(agent)
+
+if not HEADLESS:
+    pg.init()
+    game_window = pg.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+    game_window.fill(BACKGROUND_COLOR)
+    pg.display.set_caption('Simulation')
 
 
-def GameLoop(game_manager, mouse):
+# Set with the W key while training.
+watching = False
+
+
+def printStats(mouse):
+    stats = mouse.getStats()
+    print("{} / {} / {}".format(stats["nonzeroQ"], stats["liveTraces"], stats["tableSize"]))
+    if PROFILER.enabled:
+        print(f"updates {stats['updates']} | {PROFILER.summary()}")
+
+
+def GameLoop(game_manager, mouse, render=True):
+    global watching
     paused = False
 
     frameCount = 0
@@ -33,16 +72,23 @@ def GameLoop(game_manager, mouse):
     last_player_score = 0.
 
     while run_game_loop:
-        for event in pg.event.get():
+        events = []
+        if not HEADLESS and (render or paused or frameCount % EVENT_POLL_INTERVAL == 0):
+            events = pg.event.get()
+        for event in events:
             if event.type == pg.KEYDOWN:
                 if event.key == pg.K_ESCAPE:
                     run_game_loop = False
                 if event.key == pg.K_p:
                     paused = not paused
+                if event.key == pg.K_w and TRAINING_MODE:
+                    watching = not watching
+                    render = watching
                 if event.key == pg.K_b:
-                    print("{} / {} / {}".format(len([(k, v) for k, v in mouse.QE.items() if v[0] != 0.0]), len([(k, v) for k, v in mouse.QE.items() if v[1] != 0.0]), len(mouse.QE)))
+                    printStats(mouse)
             # Check to see if the user has requested that the game end.
             if event.type == pg.QUIT:
+                checkpointer.wait()
                 agent.save()
                 pg.quit()
                 pg.display.quit()
@@ -61,27 +107,46 @@ def GameLoop(game_manager, mouse):
             main_agent.deltaDamage = main_agent.deltaEnergy = 0.
             if not main_agent.alive or main_agent.score > 5000:
                 run_game_loop = False
-            if SKIP_FRAMES == 0 or frameCount % SKIP_FRAMES == 0:
+            if render and (SKIP_FRAMES == 0 or frameCount % SKIP_FRAMES == 0):
                 game_window.fill(BACKGROUND_COLOR)
                 game_manager.draw(game_window, mouse)
                 pg.display.flip()
 
             frameCount += 1
 
-            delta_time = clock.tick(FRAMES_PER_SECOND)
+            if render:
+                delta_time = clock.tick(FRAMES_PER_SECOND)
+        else:
+            # Don't spin while paused
+            clock.tick(FRAMES_PER_SECOND)
+
+if PROFILE:
+    PROFILER.enable()
 
 highScore = 0
+gm = None
 for k in range(number_of_episodes):
-    # initialize the game manager.
-    gm = GameManager(GAME_GRID_WIDTH, GAME_GRID_HEIGHT, k)
-    GameLoop(gm, agent)
+    # initialize the game manager, or start a new game in the old one.
+    episode_seed = None if SEED is None else SEED + k
+    if gm is None:
+        gm = GameManager(GAME_GRID_WIDTH, GAME_GRID_HEIGHT, k, headless=HEADLESS, seed=episode_seed)
+    else:
+        gm.reset(k, seed=episode_seed)
+    render = not HEADLESS
+    if TRAINING_MODE:
+        render = render and (watching or (RENDER_EVERY_N_EPISODES > 0 and k % RENDER_EVERY_N_EPISODES == 0))
+    GameLoop(gm, agent, render)
     if gm.main_agent.score > highScore:
         highScore = gm.main_agent.score
     if k % autosave_interval == 0:
-        agent.save()
+        checkpointer.save()
+    if PROFILE and k % PROFILE_SUMMARY_INTERVAL == 0:
+        printStats(agent)
     agent.decayEpsilon(k + 1)
 
+checkpointer.wait()
 agent.save()
 
-pg.display.quit()
-pg.quit()
\ No newline at end of file
+if not HEADLESS:
+    pg.display.quit()
+    pg.quit()
\ No newline at end of file
@@ -4,7 +4,8 @@ WINDOW_WIDTH = 500
 WINDOW_HEIGHT = 700
 
 # How many tiles should the grid have horizontally and vertically?
-# CURRENTLY ALL GRIDS MUST BE SQUARE
+# This is the default size. Any GameManager can be given its own width and
+# height, and grids don't have to be square.
 GAME_GRID_WIDTH = 15
 GAME_GRID_HEIGHT = GAME_GRID_WIDTH
 
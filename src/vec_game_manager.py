@@ -0,0 +1,101 @@
+import numpy as np
+from simulation_framework import *
+
+# Names of the sense matrices stacked by VecGameManager, in the same order
+# as AgentSense.sight_senses followed by AgentSense.smell_senses.
+SENSE_NAMES = ("elevation_sight", "food_sight", "creature_sight", "danger_sight", "food_smell", "creature_smell")
+
+# An episode ends once the player's score passes this value, like in
+# simulation_runner.py.
+MAX_EPISODE_SCORE = 5000
+
+
+class WorldSense:
+    """ The sense of a single world inside a StackedSense. Has the same
+    matrix attributes as AgentSense, so it can be given to SarsaMouse. """
+    def __init__(self, stacked_sense, index):
+        for name in SENSE_NAMES:
+            setattr(self, name, getattr(stacked_sense, name)[index])
+
+
+class StackedSense:
+    """ The main agent senses of several worlds, stacked into arrays of
+    shape (N, 5, 5) for sight and (N, 3, 3) for smell. """
+    def __init__(self, senses):
+        for name in SENSE_NAMES:
+            setattr(self, name, np.stack([getattr(sense, name) for sense in senses]))
+
+    def __len__(self):
+        return len(self.elevation_sight)
+
+    def __getitem__(self, index):
+        return WorldSense(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class VecGameManager:
+    """ Steps several independent, headless games in lockstep.
+
+    step() takes one player move per world and returns the stacked senses,
+    the rewards and which worlds finished. Finished worlds are started over
+    straight away, so the senses returned for them are the first senses of
+    their new episode, in the same GameManager. The senses they finished
+    with are kept in terminal_senses.
+
+    With a seed, every episode gets its own random streams, seeded with seed
+    plus the episode's number. """
+    def __init__(self, num_worlds, width=GAME_GRID_WIDTH, height=GAME_GRID_HEIGHT, seed=None):
+        self.num_worlds = num_worlds
+        self.seed = seed
+        self.width = width
+        self.height = height
+        # Number of episodes started so far, used as the round of new games.
+        self.episode_count = 0
+        self.games = [self.newGame() for i in range(num_worlds)]
+        self.terminal_senses = None
+
+    def newGame(self):
+        game_manager = GameManager(self.width, self.height, self.episode_count, headless=True,
+                                   seed=self.episodeSeed())
+        self.episode_count += 1
+        return game_manager
+
+    def resetGame(self, game_manager):
+        game_manager.reset(self.episode_count, seed=self.episodeSeed())
+        self.episode_count += 1
+
+    def episodeSeed(self):
+        if self.seed is None:
+            return None
+        return self.seed + self.episode_count
+
+    def getSenses(self):
+        return StackedSense([game_manager.main_agent.sense for game_manager in self.games])
+
+    def step(self, moves):
+        """ Plays one move in every world. Returns the senses to pick the next
+        moves from, the rewards and which worlds finished.
+
+        For a finished world, the action picked from the returned senses
+        starts its new episode, so it isn't the next action of the finished
+        one. Pass the dones to SarsaMouse.updateBatch: it doesn't bootstrap
+        finished worlds, so their next state and action are ignored. Episodes
+        cut off at MAX_EPISODE_SCORE are treated as finished the same way. """
+        rewards = np.zeros(self.num_worlds)
+        dones = np.zeros(self.num_worlds, dtype=bool)
+        for i, game_manager in enumerate(self.games):
+            main_agent = game_manager.main_agent
+            game_manager.logicTick(int(moves[i]))
+            rewards[i] = main_agent.deltaEnergy + main_agent.deltaDamage - 1
+            main_agent.deltaDamage = main_agent.deltaEnergy = 0.
+            dones[i] = not main_agent.alive or main_agent.score > MAX_EPISODE_SCORE
+
+        self.terminal_senses = self.getSenses()
+        if dones.any():
+            for i in np.flatnonzero(dones):
+                self.resetGame(self.games[i])
+            return self.getSenses(), rewards, dones
+        return self.terminal_senses, rewards, dones
@@ -1,7 +1,29 @@
+import sys
+import tempfile
+from os import path
 from unittest import TestCase
+import numpy as np
+
+# sarsamouse imports its sibling modules as top level modules
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "src"))
+
 from src import sarsamouse
 
 
+class Sense:
+    def __init__(self, **matrices):
+        self.__dict__.update(matrices)
+
+
+def makeSense(food=0.0, elevation=100.0):
+    return Sense(
+        food_smell=np.full((3, 3), food),
+        elevation_sight=np.full((5, 5), elevation),
+        danger_sight=np.full((5, 5), 128.0),
+        food_sight=np.full((5, 5), 128.0),
+    )
+
+
 class Test(TestCase):
     def test_create_spaces(self):
         testSpace = []
@@ -10,3 +32,234 @@ class Test(TestCase):
                 testSpace.append((i, j))
         print(sarsamouse.createSpaces([[0, 0, 0], [1, 1], [2, 2]]))
         #print(testSpace)
+
+    def test_update_drops_dead_traces(self):
+        mouse = sarsamouse.SarsaMouse(saveFname=None)
+        sense = makeSense()
+        mouse.update(sense, 0, sense, 1, 1.0)
+        self.assertEqual(mouse.table.liveTraceCount(), 1)
+        self.assertEqual(mouse.table.getQ(mouse.getStateFromSense(sense), 0), mouse.alpha)
+
+        # With no decay every trace falls below the cutoff after one update
+        mouse.lam = 0.0
+        mouse.update(sense, 1, sense, 2, 1.0)
+        self.assertEqual(mouse.table.liveTraceCount(), 0)
+        self.assertEqual(len(mouse.table), 2)
+
+    def test_array_table_matches_dict_table(self):
+        dictMouse = sarsamouse.SarsaMouse("dict", saveFname=None)
+        arrayMouse = sarsamouse.SarsaMouse("array", saveFname=None)
+        arrayMouse.table = sarsamouse.ArrayQTable(arrayMouse.actionCount, capacity=1)
+        senses = [makeSense(food, elevation) for food in (0.0, 50.0, 90.0) for elevation in (20.0, 200.0)]
+        for i in range(200):
+            state, statePrime = senses[i % len(senses)], senses[(i * 7) % len(senses)]
+            for mouse in (dictMouse, arrayMouse):
+                mouse.update(state, i % 8, statePrime, (i * 3) % 8, (i % 5) - 1.0)
+
+        self.assertEqual(sorted(dictMouse.table.items()), sorted(arrayMouse.table.items()))
+        for sense in senses:
+            state = dictMouse.getStateFromSense(sense)
+            self.assertEqual(dictMouse.table.getBestActions(state), arrayMouse.table.getBestActions(state))
+
+    def test_binary_checkpoint_round_trip(self):
+        mouse = sarsamouse.SarsaMouse(saveFname=None)
+        senses = [makeSense(food) for food in (0.0, 40.0, 80.0)]
+        for i in range(50):
+            mouse.update(senses[i % 3], i % 8, senses[(i + 1) % 3], (i + 2) % 8, i % 4 - 1.0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mouse.saveFname = path.join(tmpdir, "mouse" + sarsamouse.BINARY_SAVE_EXTENSION)
+            mouse.save()
+            for qTableType in sarsamouse.Q_TABLE_TYPES:
+                loaded = sarsamouse.SarsaMouse(qTableType, saveFname=mouse.saveFname)
+                self.assertEqual(sorted(loaded.table.items()), sorted(mouse.table.items()))
+                self.assertEqual(loaded.getSettings(), mouse.getSettings())
+
+    def test_binary_checkpoint_counters_come_from_header(self):
+        mouse = sarsamouse.SarsaMouse("array", saveFname=None)
+        senses = [makeSense(food) for food in (0.0, 40.0, 80.0)]
+        for i in range(50):
+            mouse.update(senses[i % 3], i % 8, senses[(i + 1) % 3], (i + 2) % 8, i % 4 - 1.0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mouse.saveFname = path.join(tmpdir, "mouse" + sarsamouse.BINARY_SAVE_EXTENSION)
+            mouse.save()
+            settings, arrays = sarsamouse.readCheckpoint(mouse.saveFname)
+            self.assertEqual(settings["counts"], sarsamouse.countArrays(arrays))
+            for qTableType in sarsamouse.Q_TABLE_TYPES:
+                loaded = sarsamouse.SarsaMouse(qTableType, saveFname=None)
+                loaded.loadBinary(mouse.saveFname)
+                self.assertEqual(len(loaded.table), len(mouse.table))
+                self.assertEqual(loaded.table.nonzero, mouse.table.nonzero)
+                self.assertEqual(loaded.table.liveTraceCount(), mouse.table.liveTraceCount())
+            self.assertEqual(loaded.table.liveRows, mouse.table.liveRows)
+
+    def test_async_checkpoint_saves_snapshot(self):
+        mouse = sarsamouse.SarsaMouse(saveFname=None)
+        sense = makeSense()
+        mouse.update(sense, 0, sense, 1, 1.0)
+        expected = sorted(mouse.table.items())
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mouse.saveFname = path.join(tmpdir, "mouse.json")
+            checkpointer = sarsamouse.AsyncCheckpointer(mouse, verbose=False)
+            checkpointer.save()
+            # Changes made after the snapshot aren't part of the save
+            mouse.update(sense, 2, sense, 3, 5.0)
+            checkpointer.wait()
+
+            loaded = sarsamouse.SarsaMouse(saveFname=mouse.saveFname)
+            self.assertEqual(sorted(loaded.table.items()), expected)
+            self.assertEqual(checkpointer.saveCount, 1)
+            self.assertIsNotNone(checkpointer.lastLatency)
+
+    def test_state_encoder_caches_until_sense_updates(self):
+        mouse = sarsamouse.SarsaMouse(saveFname=None)
+        sense = makeSense(food=90.0)
+        sense.stamp = 0
+        state = mouse.getStateFromSense(sense)
+
+        # Same stamp, so the cached state is returned
+        sense.food_smell = np.zeros((3, 3))
+        self.assertEqual(mouse.getStateFromSense(sense), state)
+
+        sense.stamp += 1
+        self.assertNotEqual(mouse.getStateFromSense(sense), state)
+        self.assertEqual(mouse.getStateFromSense(sense), mouse.encoder.calcState(makeSense()))
+
+    def test_state_encoder_matches_old_states(self):
+        # States worked out by the original getStateFromSense, which averaged
+        # and searched each region with np.ix_
+        def makeFixedSense(i):
+            danger = np.zeros(25)
+            danger[[i % 25, (7 * i + 3) % 25]] = 255.0
+            food = np.zeros(25)
+            food[[(3 * i + 1) % 25, (11 * i + 20) % 25]] = 255.0
+            return Sense(
+                elevation_sight=((np.arange(25) * 37 + i * 53) % 256).reshape(5, 5).astype(float),
+                danger_sight=danger.reshape(5, 5),
+                food_sight=food.reshape(5, 5),
+                food_smell=((np.arange(9) * (11 + 7 * i)) % 101).reshape(3, 3).astype(float),
+            )
+
+        mouse = sarsamouse.SarsaMouse(saveFname=None)
+        expected = [(1, 4, 1, 7289), (1, 40, 2, 9512), (0, 44, 2, -246),
+                    (2, 40, 1, 409), (2, 13, 1, 1151), (1, 40, 0, 7289)]
+        for i, state in enumerate(expected):
+            self.assertEqual(mouse.encoder.calcState(makeFixedSense(i)), state)
+
+    def test_state_from_matrix_batches(self):
+        mouse = sarsamouse.SarsaMouse(saveFname=None)
+        rng = np.random.RandomState(0)
+        matrices = rng.choice([0.0, 128.0, 255.0], (4, 3, 3))
+        states = mouse.getStateFromMatrix(matrices, [85, 170], True)
+        self.assertEqual(list(states), [mouse.getStateFromMatrix(m, [85, 170], True) for m in matrices])
+        with self.assertRaises(ValueError):
+            mouse.getStateFromMatrix(np.zeros((2, 2)), [85, 170], True)
+
+    def test_state_from_matrix_matches_old_codes(self):
+        # Codes worked out by the original loop over np.digitize
+        mouse = sarsamouse.SarsaMouse(saveFname=None)
+        space = [0.0, 85.0, 170.0, 255.0]
+        cases = [
+            (np.arange(9.0).reshape(3, 3) * 30, space, True, 134),
+            (np.array([[255.0, 0, 90], [170, 12, 84], [86, 169, 171]]), space, True, 6980),
+            (np.array([[-200.0, -125, -42], [0, 5, 41.6], [42, 125, 300]]), mouse.terrainSpace, True, -2049),
+            (np.array([[0.0, 100], [33.3, 66.7]]), mouse.scentSpace, False, 29),
+            (np.array([[1.0, 0], [0, 1]]), [0.0, 1.0], False, 2),
+            (np.arange(25.0).reshape(5, 5) * 10, space, True, 7177733),
+        ]
+        for matrix, bins, skipMiddle, code in cases:
+            self.assertEqual(mouse.getStateFromMatrix(matrix, bins, skipMiddle), code)
+
+    def test_table_counters_match_contents(self):
+        senses = [makeSense(food) for food in (0.0, 40.0, 80.0)]
+        for qTableType in sarsamouse.Q_TABLE_TYPES:
+            mouse = sarsamouse.SarsaMouse(qTableType, saveFname=None)
+            for i in range(60):
+                mouse.update(senses[i % 3], i % 8, senses[(i + 1) % 3], (i + 2) % 8, i % 3 - 1.0)
+            items = list(mouse.table.items())
+            stats = mouse.getStats()
+            self.assertEqual(stats["tableSize"], len(items))
+            self.assertEqual(stats["nonzeroQ"], sum(q != 0.0 for state, action, q, e in items))
+            self.assertEqual(stats["liveTraces"], sum(e != 0.0 for state, action, q, e in items))
+            self.assertEqual(stats["updates"], 60)
+
+    def test_batch_worlds_keep_their_own_traces(self):
+        senses = [makeSense(food) for food in (0.0, 40.0, 80.0)]
+        for qTableType in sarsamouse.Q_TABLE_TYPES:
+            mouse = sarsamouse.SarsaMouse(qTableType, saveFname=None)
+            states = [mouse.getStateFromSense(sense) for sense in senses]
+            batch = lambda *indices: Sense(**{name: np.stack([getattr(senses[i], name) for i in indices])
+                                              for name in ("food_smell", "elevation_sight", "danger_sight", "food_sight")})
+            mouse.updateBatch(batch(0, 1), [0, 1], batch(0, 1), [0, 1], [1.0, 0.0], [False, True])
+            self.assertEqual(mouse.table.getQ(states[0], 0), 1.0)
+            self.assertEqual(mouse.table.liveTraceCount(), 0)
+
+            # An error in world 0 only reaches the pair world 0 visited, and
+            # world 1's finished episode left no traces behind
+            mouse.updateBatch(batch(2, 2), [2, 2], batch(2, 2), [2, 2], [-1.0, 5.0], [False, False])
+            self.assertAlmostEqual(mouse.table.getQ(states[0], 0), 1.0 - mouse.gamma * mouse.lam)
+            self.assertEqual(mouse.table.getQ(states[1], 1), 0.0)
+            # World 1 sees the -1 world 0 left on the same pair
+            self.assertAlmostEqual(mouse.table.getQ(states[2], 2), -1.0 + 5.0 + mouse.gamma * -1.0 + 1.0)
+
+    def test_parallel_merge_leaves_no_traces(self):
+        from src import parallel_runner
+        mouse = sarsamouse.SarsaMouse(saveFname=None)
+        sense = makeSense()
+        mouse.update(sense, 0, sense, 1, 1.0)
+        state = mouse.getStateFromSense(sense)
+        parallel_runner.mergeDeltas(mouse, [([(state, 1, 0.5)], 3, [])])
+
+        self.assertEqual(mouse.table.getQ(state, 1), 0.5)
+        self.assertEqual(mouse.updateCount, 4)
+        self.assertEqual(mouse.table.liveTraceCount(), 0)
+        self.assertTrue(all(e == 0.0 for q, e in mouse.getData()["dataValues"]))
+
+    def test_empty_table_binary_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for qTableType in sarsamouse.Q_TABLE_TYPES:
+                mouse = sarsamouse.SarsaMouse(qTableType, saveFname=None)
+                mouse.saveFname = path.join(tmpdir, qTableType + sarsamouse.BINARY_SAVE_EXTENSION)
+                sarsamouse.writeSave(mouse.saveFname, mouse.getSettings(), mouse.table)
+                # Loaded directly, since SarsaMouse only prints load errors
+                loaded = sarsamouse.SarsaMouse(qTableType, saveFname=None)
+                loaded.loadBinary(mouse.saveFname)
+                self.assertEqual(len(loaded.table), 0)
+                self.assertEqual(loaded.getSettings(), mouse.getSettings())
+
+    def test_batch_update_does_not_bootstrap_finished_worlds(self):
+        senses = [makeSense(food) for food in (0.0, 80.0)]
+        batch = lambda i: Sense(**{name: getattr(senses[i], name)[np.newaxis]
+                                   for name in ("food_smell", "elevation_sight", "danger_sight", "food_sight")})
+        for done in (False, True):
+            mouse = sarsamouse.SarsaMouse(saveFname=None)
+            statePrime = mouse.getStateFromSense(senses[1])
+            mouse.table.set(statePrime, 3, 10.0, 0.0)
+            mouse.updateBatch(batch(0), [0], batch(1), [3], [1.0], [done])
+            expected = 1.0 if done else 1.0 + mouse.gamma * 10.0
+            self.assertAlmostEqual(mouse.table.getQ(mouse.getStateFromSense(senses[0]), 0), expected)
+
+    def test_parallel_worker_copy_stays_in_step(self):
+        from src import parallel_runner
+        mouse = sarsamouse.SarsaMouse(saveFname=None)
+        senses = [makeSense(food) for food in (0.0, 40.0, 80.0)]
+        for i in range(30):
+            mouse.update(senses[i % 3], i % 8, senses[(i + 1) % 3], (i + 2) % 8, i % 3 - 1.0)
+        mouse.clearTraces()
+        worker = sarsamouse.SarsaMouse(saveFname=None)
+        worker.load(mouse.getData())
+        before = {(state, action): q for state, action, q, e in worker.table.items()}
+
+        result = parallel_runner.runEpisodes(worker, (0, 0, 1, 0))
+        deltas, updateCount = result[:2]
+        self.assertGreater(updateCount, 0)
+        self.assertTrue(0 < len(deltas) <= updateCount)
+        for state, action, q, e in worker.table.items():
+            self.assertEqual((q, e), (before.get((state, action), 0.0), 0.0))
+
+        merged = parallel_runner.mergeDeltas(mouse, [result])
+        parallel_runner.applyDeltas(worker, merged)
+        for state, action, q, e in mouse.table.items():
+            self.assertEqual(worker.table.getQ(state, action), q)
@@ -0,0 +1,375 @@
+import sys
+from os import path
+from unittest import TestCase
+import numpy as np
+
+# simulation_framework imports variable_config as a top level module
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "src"))
+
+from src import simulation_framework as sf
+
+
+class Test(TestCase):
+    def test_headless_game_loads_no_assets(self):
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True)
+        for i in range(20):
+            gm.logicTick(4)
+        gm.draw(None, None)
+
+        self.assertIsNone(gm.font)
+        self.assertIsNone(gm.grid.elevation_map_img)
+        for game_object in gm.agents + gm.plants:
+            self.assertIsNone(game_object.img)
+        self.assertIsNone(gm.main_agent.sense.sm_font)
+
+    def test_smell_field_matches_fast_dist(self):
+        rng = np.random.RandomState(0)
+        sources_x = rng.randint(0, 15, 30)
+        sources_y = rng.randint(0, 15, 30)
+        strengths = rng.randint(0, 101, 30) / 100
+        tiles_x, tiles_y = np.meshgrid(np.arange(4, 7), np.arange(9, 12))
+
+        smell = sf.calc_smell_field(tiles_x, tiles_y, sources_x, sources_y, strengths)
+
+        for i in range(3):
+            for j in range(3):
+                expected = 0
+                for sx, sy, strength in zip(sources_x, sources_y, strengths):
+                    dist = sf.fast_dist(tiles_x[i, j], tiles_y[i, j], sx, sy)
+                    expected += (0.5/(dist+1))*strength*255
+                # Sources are summed pairwise, not one after another
+                self.assertAlmostEqual(smell[i, j], expected, delta=1e-12 * expected)
+
+    def test_smell_comes_from_the_entity_stores(self):
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True, seed=11)
+        gm.addEvilAgent()
+        gm.addEvilAgent()
+        for i in range(10):
+            gm.logicTick(i % 9)
+        for agent in gm.agents:
+            agent.sense.update(agent.x, agent.y, gm.grid, gm.agent_store, gm.plant_store)
+            tiles_x, tiles_y = np.meshgrid(agent.x + np.arange(-1, 2), agent.y + np.arange(-1, 2))
+            valid = gm.grid.checkValidTiles(tiles_x, tiles_y)
+            smelled = [other for other in gm.agents
+                       if other is not agent and not (agent.type == 'evil' and other.type == 'evil')]
+            creature_smell = sf.calc_smell_field(tiles_x, tiles_y, [other.x for other in smelled],
+                                                 [other.y for other in smelled], np.ones(len(smelled)))
+            food_smell = sf.calc_smell_field(tiles_x, tiles_y, [plant.x for plant in gm.plants],
+                                             [plant.y for plant in gm.plants],
+                                             [plant.energy/sf.PLANT_MAX_ENERGY for plant in gm.plants])
+            np.testing.assert_array_equal(agent.sense.creature_smell, np.where(valid, creature_smell, 0.))
+            np.testing.assert_array_equal(agent.sense.food_smell, np.where(valid, food_smell, 0.))
+
+    def test_occupancy_layers_follow_objects(self):
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True)
+        gm.addEvilAgent()
+        for i in range(50):
+            gm.logicTick(i % 9)
+
+        grid = gm.grid
+        plants = np.zeros_like(grid.plant_layer)
+        creatures = np.zeros_like(grid.creature_layer)
+        dangers = np.zeros_like(grid.danger_layer)
+        for plant in gm.plants:
+            plants[plant.x + grid.layer_padding, plant.y + grid.layer_padding] += 1
+        for agent in gm.agents:
+            creatures[agent.x + grid.layer_padding, agent.y + grid.layer_padding] += 1
+            if agent.type == 'evil':
+                dangers[agent.x + grid.layer_padding, agent.y + grid.layer_padding] += 1
+        np.testing.assert_array_equal(grid.plant_layer, plants)
+        np.testing.assert_array_equal(grid.creature_layer, creatures)
+        np.testing.assert_array_equal(grid.danger_layer, dangers)
+
+    def test_vec_game_manager_steps_every_world(self):
+        from src import vec_game_manager, sarsamouse
+        envs = vec_game_manager.VecGameManager(3)
+        mouse = sarsamouse.SarsaMouse(saveFname=None)
+        senses = envs.getSenses()
+        actions = mouse.getActions(senses)
+        for i in range(30):
+            nextSenses, rewards, dones = envs.step(actions)
+            nextActions = mouse.getActions(nextSenses)
+            mouse.updateBatch(senses, actions, envs.terminal_senses, nextActions, rewards, dones)
+            senses, actions = nextSenses, nextActions
+
+        self.assertEqual(senses.food_smell.shape, (3, 3, 3))
+        self.assertEqual(senses.danger_sight.shape, (3, 5, 5))
+        self.assertEqual(rewards.shape, (3,))
+        self.assertEqual(mouse.updateCount, 90)
+        np.testing.assert_array_equal(senses[1].elevation_sight, envs.games[1].main_agent.sense.elevation_sight)
+
+    def test_sprites_are_shared_between_objects(self):
+        first, second = sf.Agent(0, 0), sf.Agent(1, 1)
+        for agent in (first, second):
+            agent.take_damage(30)
+        self.assertIs(first.getImg(), second.getImg())
+
+        second.take_damage(1)
+        self.assertIs(first.getImg(), second.getImg())
+        second.take_damage(10)
+        self.assertIsNot(first.getImg(), second.getImg())
+        self.assertEqual(sf.SPRITE_ATLAS.getSprite(first.img_path, (sf.SQUARE_SIZE, sf.SQUARE_SIZE)).get_size(),
+                         first.getImg().get_size())
+
+    def test_seeded_terrain_is_cached(self):
+        first = sf.Grid(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, terrain_seed=3)
+        second = sf.Grid(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, terrain_seed=3)
+        self.assertIs(first.elevation_map, second.elevation_map)
+
+        np.random.seed(3)
+        unseeded = sf.Grid(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT)
+        np.testing.assert_array_equal(unseeded.elevation_map, first.elevation_map)
+        self.assertEqual(first.elevation_map.min(), 20)
+        self.assertEqual(first.elevation_map.max(), 255)
+
+    def test_height_map_blurs_all_of_the_noise(self):
+        class FixedNoise:
+            def __init__(self, noise):
+                self.noise = noise
+
+            def randint(self, low, high, size):
+                return self.noise
+
+        noise = np.random.RandomState(0).randint(0, 250, (20, 20))
+        changed = noise.copy()
+        # Not one of the every 8th values the legacy maps were made from
+        changed[3, 5] = 249 - noise[3, 5]
+        maps = [sf.calc_height_map(20, 20, FixedNoise(n)) for n in (noise, changed)]
+        self.assertNotEqual(maps[0][3, 5], maps[1][3, 5])
+        legacy_maps = [sf.calc_height_map(20, 20, FixedNoise(n), legacy=True) for n in (noise, changed)]
+        np.testing.assert_array_equal(legacy_maps[0], legacy_maps[1])
+
+    def test_reset_matches_new_game(self):
+        import random
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True)
+        for i in range(100):
+            gm.logicTick(i % 9)
+        main_agent = gm.main_agent
+
+        random.seed(5)
+        np.random.seed(5)
+        gm.reset(1)
+        random.seed(5)
+        np.random.seed(5)
+        fresh = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 1, headless=True)
+
+        self.assertIs(gm.main_agent, main_agent)
+        np.testing.assert_array_equal(gm.grid.elevation_map, fresh.grid.elevation_map)
+        np.testing.assert_array_equal(gm.grid.creature_layer, fresh.grid.creature_layer)
+        self.assertEqual([(a.type, a.id, a.x, a.y, a.energy, a.health) for a in gm.agents],
+                         [(a.type, a.id, a.x, a.y, a.energy, a.health) for a in fresh.agents])
+        self.assertEqual([(p.x, p.y, p.energy, p.stage) for p in gm.plants],
+                         [(p.x, p.y, p.energy, p.stage) for p in fresh.plants])
+
+        elevation_map = gm.grid.elevation_map
+        gm.reset(2, keep_terrain=True)
+        self.assertIs(gm.grid.elevation_map, elevation_map)
+
+    def test_terrain_pool_supplies_height_maps(self):
+        pool = sf.TerrainPool(3)
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True, terrain_pool=pool)
+        for i in range(5):
+            self.assertTrue(any(gm.grid.elevation_map is elevation_map for elevation_map in pool.maps))
+            gm.reset(i + 1)
+
+    def test_restore_state_replays_the_same_game(self):
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True)
+        gm.addEvilAgent()
+        for i in range(20):
+            gm.logicTick(i % 9)
+        gm.saveState()
+        stamp = gm.main_agent.sense.stamp
+
+        def play():
+            trace = []
+            for i in range(60):
+                gm.logicTick((i * 5) % 9)
+                trace.append([(a.id, a.x, a.y, a.energy, a.health, a.sense.food_smell.tobytes()) for a in gm.agents] +
+                             [(p.x, p.y, p.energy, p.stage) for p in gm.plants])
+            return trace
+
+        first = play()
+        gm.restoreState()
+        self.assertGreater(gm.main_agent.sense.stamp, stamp)
+        self.assertEqual(play(), first)
+        self.assertEqual(len(gm.saved_states), 1)
+
+    def test_seeded_games_replay_exactly(self):
+        import random
+
+        def play(gm):
+            trace = []
+            for i in range(80):
+                gm.logicTick(i % 9)
+                trace.append([(a.id, a.x, a.y, a.energy, a.health) for a in gm.agents] +
+                             [(p.x, p.y, p.energy) for p in gm.plants])
+            return trace
+
+        random_state = random.getstate()
+        first = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True, seed=7)
+        second = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True, seed=7)
+        np.testing.assert_array_equal(first.grid.elevation_map, second.grid.elevation_map)
+        self.assertEqual(play(first), play(second))
+        # Seeded games never touch the random module
+        self.assertEqual(random.getstate(), random_state)
+
+        second.reset(1, seed=7)
+        self.assertEqual(play(second), play(sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 1, headless=True, seed=7)))
+
+    def test_profiler_only_records_when_enabled(self):
+        profiler = sf.PROFILER
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True, seed=1)
+        profiler.reset()
+        gm.logicTick(4)
+        self.assertEqual(profiler.getStats()["phases"], {})
+
+        profiler.enable()
+        try:
+            for i in range(10):
+                gm.logicTick(i % 9)
+        finally:
+            profiler.disable()
+        phases = profiler.getStats()["phases"]
+        self.assertEqual(phases["logicTick"]["count"], 10)
+        self.assertEqual(sum(phases["logicTick"]["buckets"]), 10)
+        self.assertGreaterEqual(phases["agentTick"]["count"], 10)
+        self.assertIn("logicTick", profiler.summary())
+        profiler.reset()
+
+    def test_non_square_grid(self):
+        gm = sf.GameManager(40, 12, 0, headless=True, seed=2)
+        grid = gm.grid
+        self.assertEqual((grid.width, grid.height), (40, 12))
+        self.assertEqual(grid.elevation_map.shape, (40, 12))
+        self.assertEqual(len(gm.plants), int(sf.MAX_NUM_FOOD_ON_GRID * 40 * 12 / sf.NUM_SPACES))
+        self.assertTrue(grid.checkValidTile(39, 11))
+        self.assertFalse(grid.checkValidTile(11, 39))
+
+        for i in range(100):
+            gm.logicTick(i % 9)
+            for game_object in gm.agents + gm.plants:
+                self.assertTrue(grid.checkValidTile(game_object.x, game_object.y))
+        sense = gm.main_agent.sense
+        self.assertEqual(sense.elevation_sight.shape, (5, 5))
+        self.assertEqual(sense.food_smell.shape, (3, 3))
+
+    def test_empty_tiles_are_tracked(self):
+        grid = sf.Grid(6, 4, terrain_seed=0)
+        plants = []
+        for i in range(grid.num_spaces):
+            x, y = grid.randEmptySpace()
+            self.assertEqual(grid.occupied_grid[x, y], 0)
+            plants.append(sf.Plant(x, y))
+            grid.addOccupant(plants[-1])
+        self.assertEqual(grid.free_count, 0)
+        self.assertEqual(grid.occupied_grid.min(), 1)
+
+        grid.removeOccupant(plants[5])
+        self.assertEqual(grid.randEmptySpace(), (plants[5].x, plants[5].y))
+
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True, seed=4)
+        for i in range(100):
+            gm.logicTick(i % 9)
+        grid = gm.grid
+        free = set(grid.free_tiles[:grid.free_count])
+        self.assertEqual(free, set(np.flatnonzero(grid.occupied_grid.reshape(-1) == 0).tolist()))
+
+    def test_evil_agents_attack_and_eat_through_tile_index(self):
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True, seed=6)
+        gm.addEvilAgent()
+        evil = gm.agents[-1]
+        prey = gm.main_agent
+        gm.grid.moveOccupant(evil, prey.x, prey.y)
+        evil.move_instant(prey.x, prey.y)
+        prey.health = 5
+
+        gm.agentTick(evil, 4)
+        self.assertFalse(prey.alive)
+        self.assertEqual(list(gm.dead_prey), [prey])
+
+        prey.energy = 15
+        gm.agentTick(evil, 4)
+        self.assertEqual(prey.energy, 5)
+        gm.agentTick(evil, 4)
+        self.assertNotIn(prey, gm.agents)
+        self.assertEqual(gm.dead_prey, {})
+        self.assertNotIn(prey, gm.grid.getAgentsAt(prey.x, prey.y))
+        self.assertEqual([agent.list_index for agent in gm.agents], list(range(len(gm.agents))))
+
+    def test_game_objects_live_in_entity_stores(self):
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True, seed=10)
+        gm.addEvilAgent()
+        for i in range(50):
+            gm.logicTick(i % 9)
+        self.assertIs(gm.plants, gm.plant_store.objects)
+        self.assertEqual([plant.slot for plant in gm.plants], list(range(len(gm.plants))))
+        self.assertEqual(set(gm.agent_store.objects), set(gm.agents))
+        self.assertEqual(gm.plant_store.view("energy").tolist(), [plant.energy for plant in gm.plants])
+
+        # A plant taken off the grid keeps its values
+        plant = gm.plants[0]
+        values = (plant.x, plant.y, plant.energy, plant.stage)
+        gm.removePlant(plant)
+        self.assertIsNone(plant.store)
+        self.assertEqual((plant.x, plant.y, plant.energy, plant.stage), values)
+        self.assertNotIn(plant, gm.plants)
+
+        elevation_map = gm.grid.elevation_map
+        agents = list(gm.agents)
+        moves = [i % 9 for i in range(len(agents))]
+        for agent, move, target in zip(agents, moves, gm.calcMoveTargets(agents, moves)):
+            offset_x, offset_y, _ = sf.dir2offset(move)
+            new_x, new_y = agent.x + offset_x, agent.y + offset_y
+            if not gm.grid.checkValidTile(new_x, new_y):
+                self.assertIsNone(target)
+                continue
+            cost = sf.DEFAULT_TERRAIN_DIFFICULTY + (int(elevation_map[new_x][new_y]) - int(elevation_map[agent.x][agent.y]))/255
+            self.assertEqual(target, (new_x, new_y, cost))
+
+    def test_plant_tick_grows_all_plants_at_once(self):
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True, seed=8)
+        start = [plant.energy for plant in gm.plants]
+        for i in range(30):
+            gm.plantTick()
+        for plant, energy in zip(gm.plants, start):
+            self.assertTrue(energy < plant.energy <= min(energy + 30, sf.PLANT_MAX_ENERGY))
+            self.assertEqual(plant.stage, plant.energy2stage())
+
+        # The image only follows the stage once the plant is drawn
+        plant = gm.plants[0]
+        self.assertEqual(plant.img_path, f"{plant.raw_img_path}1.png")
+        plant.getImg(8)
+        self.assertEqual(plant.img_path, f"{plant.raw_img_path}{plant.stage}.png")
+
+    def test_batched_movements_follow_each_agents_smell(self):
+        gm = sf.GameManager(sf.GAME_GRID_WIDTH, sf.GAME_GRID_HEIGHT, 0, headless=True, seed=9)
+        gm.addEvilAgent()
+        herbivore = sf.Agent(0, 0, rng=gm.rng)
+        evil = gm.agents[-1]
+        faint = sf.Agent(0, 0, rng=gm.rng)
+        for agent in (herbivore, evil, faint):
+            agent.good_choice_chance = 1.0
+            agent.sense.food_smell = np.zeros((3, 3))
+            agent.sense.creature_smell = np.zeros((3, 3))
+        herbivore.sense.food_smell[0, 2] = 150
+        herbivore.sense.creature_smell[2, 2] = 200
+        evil.sense.creature_smell[1, 0] = 150
+        faint.sense.food_smell[2, 1] = 99
+
+        for i in range(20):
+            moves = gm.chooseMovements([herbivore, evil, faint])
+            self.assertEqual(moves[:2], [herbivore.choose_movement(), 3])
+            self.assertIn(moves[2], range(9))
+        # Too faint to follow, so the moves are random
+        self.assertGreater(len({gm.chooseMovements([faint])[0] for i in range(50)}), 1)
+
+    def test_plant_growth_values_are_shared(self):
+        plant = sf.Plant(0, 0)
+        for attribute in ("growth_rate", "max_energy", "num_stages", "energy_steps"):
+            self.assertFalse(hasattr(plant, attribute))
+        energies = np.arange(-5, sf.PLANT_MAX_ENERGY + 6)
+        stages = []
+        for energy in energies:
+            plant.energy = int(energy)
+            stages.append(plant.energy2stage())
+        self.assertEqual(sf.calc_plant_stages(energies).tolist(), stages)